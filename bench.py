@@ -0,0 +1,451 @@
+import os
+import sys
+import json
+import time
+import fnmatch
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import statistics
+from collections import deque
+from datetime import datetime
+import paramiko
+from paramiko import ServerInterface, SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK, AUTH_SUCCESSFUL, OPEN_SUCCEEDED
+from rich.console import Console
+from rich.table import Table
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+REPORT_FILE = "bench-report.json"
+BENCH_RUNS = 5
+SHELL_RUNS = 20
+SMALL_FILES = 200
+SMALL_SIZE = 4096
+LARGE_MB = 80
+DB_SERVERS = 10000
+REGRESSION_THRESHOLD = 10
+REGRESSION_FLOOR = 0.002
+LINK_CHUNK = 65536
+
+console = Console()
+
+# SFTP-сервер поверх локальной ФС: относительные пути считаются от домашнего каталога стенда
+class _Handle(SFTPHandle):
+    def stat(self):
+        try: return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e: return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try: SFTPServer.set_file_attr(self.filename, attr)
+        except OSError as e: return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+class _FS(SFTPServerInterface):
+    root = "/"
+
+    def _path(self, path):
+        return path if path.startswith("/") else os.path.join(self.root, path)
+
+    def _call(self, fn, *args):
+        try: fn(*args)
+        except OSError as e: return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            entries = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e: return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try: return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e: return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try: return SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e: return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try: fd = os.open(path, flags, getattr(attr, "st_mode", None) or 0o666)
+        except OSError as e: return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY: mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR: mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else: mode = "rb"
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path): return self._call(os.remove, self._path(path))
+    def rename(self, old, new): return self._call(os.rename, self._path(old), self._path(new))
+    def posix_rename(self, old, new): return self._call(os.replace, self._path(old), self._path(new))
+    def mkdir(self, path, attr): return self._call(os.mkdir, self._path(path))
+    def rmdir(self, path): return self._call(os.rmdir, self._path(path))
+    def chattr(self, path, attr): return self._call(SFTPServer.set_file_attr, self._path(path), attr)
+    def canonicalize(self, path): return os.path.realpath(self._path(path))
+
+# SSH-сервер стенда: любой пароль или ключ, exec и shell запускаются локально в домашнем каталоге стенда
+class _Server(ServerInterface):
+    def __init__(self, home):
+        self.home = home
+
+    def check_auth_password(self, username, password): return AUTH_SUCCESSFUL
+    def check_auth_publickey(self, username, key): return AUTH_SUCCESSFUL
+    def get_allowed_auths(self, username): return "password,publickey"
+    def check_channel_request(self, kind, chanid): return OPEN_SUCCEEDED
+    def check_channel_pty_request(self, *args): return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._run, args=(channel, ["/bin/sh", "-c", command.decode()]), daemon=True).start()
+        return True
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=self._run, args=(channel, ["/bin/sh"]), daemon=True).start()
+        return True
+
+    def _run(self, channel, argv):
+        proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.home, env=dict(os.environ, HOME=self.home))
+        def feed():
+            try:
+                while True:
+                    data = channel.recv(LINK_CHUNK)
+                    if not data: break
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except (OSError, EOFError): pass
+            finally:
+                try: proc.stdin.close()
+                except OSError: pass
+        # клиент закрыл канал: процесс больше некому читать, он завершается
+        def pump(stream, send):
+            try:
+                for data in iter(lambda: os.read(stream.fileno(), LINK_CHUNK), b""): send(data)
+            except (OSError, EOFError): proc.kill()
+        threading.Thread(target=feed, daemon=True).start()
+        pumps = [threading.Thread(target=pump, args=(proc.stdout, channel.sendall)), threading.Thread(target=pump, args=(proc.stderr, channel.sendall_stderr))]
+        for t in pumps: t.start()
+        for t in pumps: t.join()
+        try:
+            channel.send_exit_status(proc.wait())
+            channel.close()
+        except (OSError, EOFError): pass
+
+# сервер на loopback в этом же процессе; каждое подключение — свой транспорт в своём потоке
+class StandIn:
+    def __init__(self, home):
+        self.home = home
+        self.key = paramiko.RSAKey.generate(2048)
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        _FS.root = home
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try: sock, _ = self.listener.accept()
+            except OSError: return
+            threading.Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock):
+        # как sshd для интерактивных сессий: без алгоритма Нейгла
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.key)
+        transport.set_subsystem_handler("sftp", SFTPServer, _FS)
+        transport.start_server(server=_Server(self.home))
+        # принятые каналы держатся до закрытия: paramiko закрывает канал без ссылок на него
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel: channels = [c for c in channels if not c.closed] + [channel]
+
+    def close(self):
+        self.listener.close()
+
+# прокси с задержкой и ограничением скорости между клиентом и сервером стенда.
+# Каждый кусок данных доставляется не раньше чем через latency/2 после чтения и не быстрее
+# bandwidth; чтение не ждёт доставки, поэтому конвейер запросов не разрывается
+class Link:
+    def __init__(self, target_port, latency=0.0, bandwidth=0.0):
+        self.target = ("127.0.0.1", target_port)
+        self.delay = latency / 2
+        self.bandwidth = bandwidth
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try: client, _ = self.listener.accept()
+            except OSError: return
+            server = socket.create_connection(self.target)
+            for sock in (client, server): sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._direction(client, server)
+            self._direction(server, client)
+
+    def _direction(self, src, dst):
+        queue = deque()
+        ready = threading.Condition()
+        def read():
+            last = 0.0
+            while True:
+                try: data = src.recv(LINK_CHUNK)
+                except OSError: data = b""
+                now = time.perf_counter()
+                due = now + self.delay
+                if data and self.bandwidth: due = max(due, last) + len(data) / self.bandwidth
+                last = due
+                with ready:
+                    queue.append((due, data))
+                    ready.notify()
+                if not data: return
+        def write():
+            while True:
+                with ready:
+                    while not queue: ready.wait()
+                    due, data = queue.popleft()
+                pause = due - time.perf_counter()
+                if pause > 0: time.sleep(pause)
+                try:
+                    if data: dst.sendall(data)
+                    else: dst.shutdown(socket.SHUT_WR)
+                except OSError: return
+                if not data: return
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+# замеры: каждый тест — несколько прогонов, в отчёт идут все времена и медиана
+class Bench:
+    def __init__(self, opts, workdir):
+        self.opts = opts
+        self.workdir = workdir
+        self.results = {}
+        os.chdir(workdir)
+        import main
+        self.main = main
+        # вывод программы во время замеров не нужен и искажал бы время
+        main.console = Console(file=open(os.devnull, "w", encoding="utf-8"), width=120)
+        self.home = os.path.join(workdir, "remote")
+        os.makedirs(self.home)
+        self.standin = StandIn(self.home)
+        self.link = Link(self.standin.port, opts.latency / 1000, opts.bandwidth * 1000 * 1000 / 8)
+        self.server = {"name": "bench", "host": f"127.0.0.1:{self.link.port}", "user": "bench", "password": "bench", "os": "ubuntu",
+                       "setup_done": True, "auth_type": "password", "key_path": None, "group": "", "show_info": False, "tags": []}
+        main.db.save_server(self.server)
+
+    def wanted(self, name):
+        return not self.opts.only or any(fnmatch.fnmatch(name, p) for p in self.opts.only.split(","))
+
+    # timed — fn сама возвращает время (например, метрику программы), иначе замеряется вызов целиком
+    def measure(self, name, fn, runs=None, size=None, prepare=None, timed=False):
+        if not self.wanted(name): return
+        times = []
+        for _ in range(runs or self.opts.runs):
+            if prepare: prepare()
+            started = time.perf_counter()
+            result = fn()
+            times.append(result if timed else time.perf_counter() - started)
+        self.record(name, times, size)
+
+    def record(self, name, times, size=None):
+        entry = {"runs": [round(t, 6) for t in times], "median": statistics.median(times), "min": min(times), "max": max(times)}
+        if size: entry.update(bytes=size, throughput=size / entry["median"])
+        self.results[name] = entry
+        console.print(f"  {name}: {entry['median'] * 1000:.1f} мс", style="dim")
+
+    # сессия connect_to_server: время до промпта берётся из метрики, которую пишет сама программа,
+    # время до готовности оболочки (она запускается в фоне после промпта) — по возврату open_shell
+    def session(self, cold):
+        main = self.main
+        if cold: main.pool.close_all()
+        answers = ["exit"]
+        main.Prompt.ask = staticmethod(lambda *a, **k: answers.pop(0))
+        main.Confirm.ask = staticmethod(lambda *a, **k: False)
+        open_shell, ready = main.open_shell, []
+        def timed_open_shell(*args):
+            result = open_shell(*args)
+            ready.append(time.perf_counter())
+            return result
+        main.open_shell = timed_open_shell
+        started = time.perf_counter()
+        try: main.connect_to_server(dict(self.server))
+        finally: main.open_shell = open_shell
+        to_prompt = main.db.query("SELECT to_prompt FROM connect_metrics ORDER BY id DESC LIMIT 1")[0][0]
+        return to_prompt, ready[0] - started
+
+    def run_connect(self):
+        for kind, cold in (("cold", True), ("warm", False)):
+            names = [f"connect_{kind}", f"connect_shell_{kind}"]
+            if not any(self.wanted(name) for name in names): continue
+            runs = [self.session(cold) for _ in range(self.opts.runs)]
+            for name, times in zip(names, zip(*runs)):
+                if self.wanted(name): self.record(name, list(times))
+
+    def run_infovds(self):
+        ssh = self.main.pool.get(self.server)
+        self.measure("infovds_refresh", lambda: self.main.show_infovds(ssh, self.server, refresh=True))
+        self.measure("infovds_cached", lambda: self.main.show_infovds(ssh, self.server))
+
+    def run_shell(self):
+        if not self.wanted("repl_command"): return
+        shell = self.main.RemoteShell(self.main.pool.get(self.server))
+        self.measure("repl_command", lambda: shell.run("echo bench"), runs=SHELL_RUNS)
+        shell.close()
+
+    def run_transfers(self):
+        main = self.main
+        local = os.path.join(self.workdir, "local")
+        small = os.path.join(local, "small")
+        os.makedirs(small)
+        payload = os.urandom(self.opts.small_size)
+        for i in range(self.opts.small_files):
+            sub = os.path.join(small, f"d{i % 10}")
+            os.makedirs(sub, exist_ok=True)
+            with open(os.path.join(sub, f"f{i}.bin"), "wb") as f: f.write(payload)
+        large = os.path.join(local, "large.bin")
+        with open(large, "wb") as f:
+            for _ in range(self.opts.large_mb): f.write(os.urandom(1024 * 1024))
+        small_bytes = self.opts.small_files * self.opts.small_size
+        large_bytes = self.opts.large_mb * 1024 * 1024
+        sftp = main.pool.get(self.server).open_sftp()
+
+        def clean(*paths):
+            def prepare():
+                for path in paths:
+                    if os.path.isdir(path): shutil.rmtree(path)
+                    elif os.path.exists(path): os.remove(path)
+            return prepare
+        def transfer(fn, src, dst):
+            engine = fn(sftp, src, dst)
+            if engine.errors: raise RuntimeError(f"{fn.__name__}: {engine.errors[0]}")
+        self.measure("upload_small", lambda: transfer(main.upload_item, small, "small_up"), size=small_bytes, prepare=clean(os.path.join(self.home, "small_up")))
+        self.measure("download_small", lambda: transfer(main.download_item, "small_up", os.path.join(local, "small_down")), size=small_bytes, prepare=clean(os.path.join(local, "small_down")))
+        self.measure("upload_large", lambda: transfer(main.upload_item, large, "large.bin"), size=large_bytes, prepare=clean(os.path.join(self.home, "large.bin")))
+        self.measure("download_large", lambda: transfer(main.download_item, "large.bin", os.path.join(local, "large_down.bin")), size=large_bytes, prepare=clean(os.path.join(local, "large_down.bin")))
+        sftp.close()
+
+    # БД: отдельный файл на DB_SERVERS серверов, запись пакетом, полная загрузка и страница поиска
+    def run_db(self):
+        main = self.main
+        saved = main.db
+        path = os.path.join(self.workdir, "bench.db")
+        template = {k: v for k, v in self.server.items() if k not in ("id", "secret")}
+        servers = [dict(template, name=f"web{i}", host=f"10.0.{i // 250}.{i % 250}", tags=["bench"]) for i in range(self.opts.servers)]
+        def save():
+            if main.db is not saved: main.db.close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix): os.remove(path + suffix)
+            main.db = main.Database(path)
+            with main.db.batch():
+                for server in servers: main.db.save_server(dict(server))
+        try:
+            self.measure("db_save", save, runs=max(1, self.opts.runs // 2))
+            self.measure("db_load", main.db.servers)
+            self.measure("db_inventory_page", lambda: main.db.inventory(offset=main.INVENTORY_PAGE * 10, limit=main.INVENTORY_PAGE))
+            self.measure("db_inventory_search", lambda: main.db.inventory("wb99", limit=main.INVENTORY_PAGE))
+        finally:
+            main.db.close()
+            main.db = saved
+
+    def run(self):
+        for step in (self.run_connect, self.run_infovds, self.run_shell, self.run_transfers, self.run_db): step()
+        self.main.pool.close_all()
+        self.link.close()
+        self.standin.close()
+
+    def report(self):
+        return {
+            "meta": {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "paramiko": paramiko.__version__,
+                "platform": platform.platform(),
+                "latency_ms": self.opts.latency,
+                "bandwidth_mbit": self.opts.bandwidth,
+                "runs": self.opts.runs,
+                "small_files": self.opts.small_files,
+                "small_size": self.opts.small_size,
+                "large_mb": self.opts.large_mb,
+                "servers": self.opts.servers,
+            },
+            "results": self.results,
+        }
+
+# таблица результатов; с базой — разница медиан в процентах. Регрессия — рост больше порога
+# и больше REGRESSION_FLOOR секунд: у тестов в доли миллисекунды проценты — это шум
+def compare(report, baseline=None, threshold=REGRESSION_THRESHOLD):
+    t = Table(title=f"Бенчмарк: задержка {report['meta']['latency_ms']} мс, канал {report['meta']['bandwidth_mbit'] or '∞'} Мбит/с")
+    t.add_column("Тест", no_wrap=True)
+    for col in ["Медиана", "Мин", "Макс", "Скорость"] + (["База", "Δ"] if baseline else []): t.add_column(col, justify="right", no_wrap=True)
+    regressions = []
+    for name, entry in report["results"].items():
+        speed = f"{entry['throughput'] / 1024 / 1024:.1f} МБ/с" if entry.get("throughput") else ""
+        row = [name, f"{entry['median'] * 1000:.1f} мс", f"{entry['min'] * 1000:.1f} мс", f"{entry['max'] * 1000:.1f} мс", speed]
+        base = (baseline or {}).get("results", {}).get(name)
+        if base:
+            delta = (entry["median"] - base["median"]) / base["median"] * 100
+            slower = delta > threshold and entry["median"] - base["median"] > REGRESSION_FLOOR
+            if slower: regressions.append(name)
+            style = "red" if slower else "green" if delta < -threshold else ""
+            row += [f"{base['median'] * 1000:.1f} мс", f"[{style}]{delta:+.1f}%[/]" if style else f"{delta:+.1f}%"]
+        elif baseline: row += ["—", ""]
+        t.add_row(*row)
+    console.print(t)
+    if baseline:
+        differs = [k for k in ("latency_ms", "bandwidth_mbit", "small_files", "small_size", "large_mb", "servers") if baseline.get("meta", {}).get(k) != report["meta"][k]]
+        if differs: console.print(f"⚠️ Параметры базы отличаются: {', '.join(differs)}", style="yellow")
+    return regressions
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Бенчмарк SSHSCRE против SSH/SFTP-сервера в этом же процессе")
+    p.add_argument("--latency", type=float, default=0, help="задержка туда-обратно, мс")
+    p.add_argument("--bandwidth", type=float, default=0, help="пропускная способность, Мбит/с (0 — без ограничения)")
+    p.add_argument("--runs", type=int, default=BENCH_RUNS, help="прогонов на тест")
+    p.add_argument("--small-files", type=int, default=SMALL_FILES, help="файлов в дереве мелких файлов")
+    p.add_argument("--small-size", type=int, default=SMALL_SIZE, help="размер мелкого файла, байт")
+    p.add_argument("--large-mb", type=int, default=LARGE_MB, help="размер большого файла, МБ")
+    p.add_argument("--servers", type=int, default=DB_SERVERS, help="серверов в тесте БД")
+    p.add_argument("--only", help="только тесты по маскам через запятую (connect_*, db_*)")
+    p.add_argument("--output", default=REPORT_FILE, help="файл отчёта JSON")
+    p.add_argument("--baseline", help="отчёт для сравнения")
+    p.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="порог регрессии, %%")
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    opts = parse_args()
+    output = os.path.abspath(opts.output)
+    baseline = None
+    if opts.baseline:
+        with open(opts.baseline, encoding="utf-8") as f: baseline = json.load(f)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="sshscre-bench-") as workdir:
+        bench = Bench(opts, workdir)
+        console.print(f"⏱️ Стенд на 127.0.0.1:{bench.link.port}, рабочий каталог {workdir}", style="cyan")
+        try: bench.run()
+        finally: os.chdir(cwd)
+        report = bench.report()
+    with open(output, "w", encoding="utf-8") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    regressions = compare(report, baseline, opts.threshold)
+    console.print(f"📄 Отчёт: {output}", style="green")
+    if regressions:
+        console.print(f"❌ Регрессии: {', '.join(regressions)}", style="red")
+        sys.exit(1)
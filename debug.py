@@ -1,19 +1,84 @@
 import sys
 import os
 import time
+import json
+import threading
+import functools
 import traceback
+from collections import deque
 from datetime import datetime
 
+BOOT = time.perf_counter()
 LOG_FILE = "debug.log"
+TRACE_FILE = "trace.jsonl"
+TRACE_EXPORT = "trace.json"
+TRACE_MAX_BYTES = 8 * 1024 * 1024
+TRACE_BACKUPS = 3
+TRACE_QUEUE = 100000
+TRACE_SAMPLES = 1000
+WRITER_INTERVAL = 0.5
+EXEC_ARG_LIMIT = 120
+
+# запись в файл из фонового потока пачками; при превышении размера файл ротируется (.1, .2, ...)
+class BufferedWriter:
+    def __init__(self, path, fmt=str, max_bytes=TRACE_MAX_BYTES, backups=TRACE_BACKUPS):
+        self.path = path
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.backups = backups
+        # при переполнении очереди теряются самые старые записи, а не тормозит программа
+        self.queue = deque(maxlen=TRACE_QUEUE)
+        self.wake = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name="trace-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, item):
+        self.queue.append(item)
+
+    def flush(self):
+        batch = []
+        while self.queue:
+            try: batch.append(self.fmt(self.queue.popleft()))
+            except IndexError: break
+        if not batch: return
+        with open(self.path, "a", encoding="utf-8") as f: f.write("\n".join(batch) + "\n")
+        if self.max_bytes and os.path.getsize(self.path) > self.max_bytes: self.rotate()
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"): os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups: os.replace(self.path, f"{self.path}.1")
+        else: os.remove(self.path)
+
+    # файлы от старых к новым
+    def files(self):
+        rotated = [f"{self.path}.{i}" for i in range(self.backups, 0, -1)]
+        return [p for p in rotated + [self.path] if os.path.exists(p)]
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join(timeout=5)
+        self.flush()
+
+    def _loop(self):
+        while self.running:
+            self.wake.wait(WRITER_INTERVAL)
+            self.wake.clear()
+            try: self.flush()
+            except OSError: pass
+
+_log_writer = BufferedWriter(LOG_FILE, max_bytes=0)
+_original_print = print
 
 def log(msg, tag="DEBUG"):
     now = datetime.now().strftime("%H:%M:%S")
     line = f"[{now}] [{tag}] {msg}"
-    print(f"\033[90m{line}\033[0m") 
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(line + "\n")
+    # исходный print: подменённый снова вызвал бы log
+    _original_print(f"\033[90m{line}\033[0m")
+    _log_writer.write(line)
 
-_original_print = print
 def debug_print(*args, **kwargs):
     _original_print(*args, **kwargs)
     msg = " ".join(str(arg) for arg in args)
@@ -21,6 +86,112 @@ def debug_print(*args, **kwargs):
 
 print = debug_print
 
+# трассировка: интервалы (spans) с длительностью пишутся в TRACE_FILE строками JSON,
+# по каждой операции копится сводка; без трассировки функции не подменяются вовсе
+class Tracer:
+    def __init__(self, path=TRACE_FILE):
+        self.writer = BufferedWriter(path, fmt=lambda event: json.dumps(event, ensure_ascii=False))
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.stats = {}
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, cat, start, args=None):
+        end = time.perf_counter()
+        tid = threading.get_ident()
+        if tid not in self.threads: self.threads[tid] = threading.current_thread().name
+        event = {"name": name, "cat": cat, "ts": round((start - self.origin) * 1e6), "dur": round((end - start) * 1e6), "tid": tid}
+        if args: event["args"] = args
+        self.writer.write(event)
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None: stat = self.stats[name] = {"count": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=TRACE_SAMPLES)}
+            stat["count"] += 1
+            stat["total"] += end - start
+            stat["max"] = max(stat["max"], end - start)
+            stat["samples"].append(end - start)
+
+    # подмена функции или метода обёрткой с замером; describe(args) даёт подпись интервала
+    def wrap(self, owner, attr, name=None, cat="app", describe=None):
+        original = getattr(owner, attr, None)
+        if original is None: return
+        name = name or f"{getattr(owner, '__name__', 'main')}.{attr}"
+        tracer = self
+        @functools.wraps(original)
+        def traced(*args, **kwargs):
+            start = time.perf_counter()
+            try: return original(*args, **kwargs)
+            finally: tracer.record(name, cat, start, describe(args) if describe else None)
+        setattr(owner, attr, traced)
+
+    # сводка по операциям: число вызовов, суммарное, среднее, p50, p95 и максимальное время
+    def summary(self):
+        rows = []
+        with self.lock:
+            for name, stat in self.stats.items():
+                samples = sorted(stat["samples"])
+                pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+                rows.append((name, stat["count"], stat["total"], stat["total"] / stat["count"], pick(0.5), pick(0.95), stat["max"]))
+        return sorted(rows, key=lambda row: -row[2])
+
+    # Chrome trace (chrome://tracing, Perfetto) из всех файлов трассировки, включая ротированные
+    def export(self, path=TRACE_EXPORT):
+        self.writer.flush()
+        events = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}} for tid, name in self.threads.items()]
+        for part in self.writer.files():
+            with open(part, encoding="utf-8") as f:
+                for line in f:
+                    try: event = json.loads(line)
+                    except ValueError: continue
+                    events.append(dict(event, ph="X", pid=self.pid))
+        with open(path, "w", encoding="utf-8") as f: json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return len(events)
+
+    def close(self):
+        self.writer.close()
+
+def _command(args):
+    return {"cmd": str(args[1])[:EXEC_ARG_LIMIT]} if len(args) > 1 else None
+
+def _sql(args):
+    return {"sql": " ".join(str(args[1]).split())[:EXEC_ARG_LIMIT]} if len(args) > 1 else None
+
+def _path(args):
+    return {"path": str(args[1])} if len(args) > 1 else None
+
+# горячие пути main.py и paramiko: подключение, infovds, передача файлов, БД, каналы и SFTP.
+# paramiko в main загружается лениво: его классы оборачиваются в момент загрузки
+def instrument(tracer, main):
+    for name in ["connect_to_server", "show_infovds", "probe_info", "run_probe", "handle_file_cmd", "upload_item", "download_item",
+                 "sync_item", "walk_remote", "remote_manifest", "list_remote_tree", "open_client", "open_sftp", "open_shell", "shell_ready",
+                 "run_on_host", "fanout", "provision_host", "tune_transport", "save_session"]:
+        tracer.wrap(main, name)
+    for name, value in list(vars(main.Database).items()):
+        if callable(value) and not name.startswith("_") and name != "batch":
+            tracer.wrap(main.Database, name, f"db.{name}", "db", _sql if name in ("query", "execute") else None)
+    for cls, names in [(main.RemoteShell, ["start", "run"]), (main.ConnectionPool, ["get", "acquire", "channel", "replace"]),
+                       (main.History, ["flush", "search"]), (main.Vault, ["unlock", "rotate"]), (main.PathCache, ["listdir"])]:
+        for name in names: tracer.wrap(cls, name)
+    main.paramiko.when_loaded(lambda paramiko: instrument_paramiko(tracer, paramiko))
+
+def instrument_paramiko(tracer, paramiko):
+    tracer.wrap(paramiko.SSHClient, "connect", "ssh.connect", "ssh")
+    tracer.wrap(paramiko.Transport, "open_channel", "ssh.open_channel", "ssh")
+    tracer.wrap(paramiko.Transport, "renegotiate_keys", "ssh.rekey", "ssh")
+    tracer.wrap(paramiko.Channel, "exec_command", "ssh.exec_command", "ssh", _command)
+    tracer.wrap(paramiko.Transport, "open_sftp_client", "sftp.session", "sftp")
+    for name in ["open", "stat", "lstat", "listdir_attr", "normalize", "mkdir", "utime", "chmod", "remove", "rename", "posix_rename"]:
+        tracer.wrap(paramiko.SFTPClient, name, f"sftp.{name}", "sftp", _path)
+
+def report(tracer):
+    rows = tracer.summary()
+    if not rows: return
+    log(f"{'Операция':<32} {'Вызовов':>8} {'Всего, с':>10} {'Среднее, мс':>12} {'p50, мс':>9} {'p95, мс':>9} {'Макс, мс':>9}", "TRACE")
+    for name, count, total, mean, p50, p95, peak in rows:
+        log(f"{name:<32} {count:>8} {total:>10.3f} {mean * 1000:>12.2f} {p50 * 1000:>9.2f} {p95 * 1000:>9.2f} {peak * 1000:>9.2f}", "TRACE")
+    log(f"Chrome trace: {TRACE_EXPORT} ({tracer.export()} событий), сырые интервалы: {TRACE_FILE}", "TRACE")
+
 def handle_exception(exc_type, exc_value, exc_traceback):
     if issubclass(exc_type, KeyboardInterrupt):
         sys.__excepthook__(exc_type, exc_value, exc_traceback)
@@ -42,18 +213,26 @@ def inject_sysinfo():
 
 if __name__ == "__main__":
     VERSION = "v0.1.2"
+    tracing = "--no-trace" not in sys.argv[1:]
     log(f"=== ЗАПУСК SSHSCRE {VERSION} В РЕЖИМЕ ОТЛАДКИ ===", "BOOT")
     log(f"Python {sys.version}", "ENV")
     log(f"Рабочая директория: {os.getcwd()}", "ENV")
 
-    if not os.path.exists("sshscree.py"):
-        log("❌ ОШИБКА: файл sshscree.py не найден", "CRASH")
+    if not os.path.exists("main.py"):
+        log("❌ ОШИБКА: файл main.py не найден", "CRASH")
         sys.exit(1)
-    
+
+    tracer = None
+    shown = []
     try:
         from rich.prompt import Prompt
         _original_ask = Prompt.ask
         def debug_ask(*args, **kwargs):
+            # первый запрос ввода — это меню: время от запуска и что из тяжёлых модулей уже загружено
+            if not shown:
+                shown.append(True)
+                modules = ", ".join(f"{m}: {'загружен' if m in sys.modules else 'отложен'}" for m in ("paramiko", "cryptography", "rich.table", "rich.progress"))
+                log(f"Меню через {(time.perf_counter() - BOOT) * 1000:.0f} мс после запуска ({modules})", "BOOT")
             result = _original_ask(*args, **kwargs)
             log(f"Ввод: {result}", "INPUT")
             return result
@@ -62,32 +241,26 @@ if __name__ == "__main__":
         start_time = time.time()
         log("Запуск SSHscre...", "BOOT")
 
-        import sshscree
-        if hasattr(sshscree, 'main_menu'):
+        started = time.perf_counter()
+        import main
+        log(f"Импорт main: {(time.perf_counter() - started) * 1000:.0f} мс", "BOOT")
+        if hasattr(main, 'main_menu'):
             inject_sysinfo()
             log("✅ Основной модуль импортирован", "BOOT")
-            if os.path.exists("servers.db"):
-                import sqlite3
-                conn = sqlite3.connect("servers.db")
-                c = conn.cursor()
-                c.execute("PRAGMA table_info(servers)")
-                servers_cols = [col[1] for col in c.fetchall()]
-                c.execute("PRAGMA table_info(sessions)")
-                sessions_cols = [col[1] for col in c.fetchall()]
-                conn.close()
-                
-                log(f"Структура БД servers: {', '.join(servers_cols)}", "DB")
-                log(f"Структура БД sessions: {', '.join(sessions_cols)}", "DB")
-                if os.path.exists("UpdateSQL.py"):
-                    log("✅ UpdateSQL.py найден", "DB")
-                else:
-                    log("⚠️ UpdateSQL.py не найден", "DB")
-            else:
-                log("⚠️ База данных servers.db не найдена", "DB")
-            
-            sshscree.main_menu()
+            if tracing:
+                tracer = Tracer()
+                instrument(tracer, main)
+                log(f"Трассировка включена: {TRACE_FILE} (отключить: --no-trace)", "TRACE")
+            main.start()
+            servers_cols = [row[1] for row in main.db.query("PRAGMA table_info(servers)")]
+            sessions_cols = [row[1] for row in main.db.query("PRAGMA table_info(sessions)")]
+            log(f"Структура БД servers: {', '.join(servers_cols)}", "DB")
+            log(f"Структура БД sessions: {', '.join(sessions_cols)}", "DB")
+            log(f"Версия схемы БД: {main.db.migrated[1]} (была {main.db.migrated[0]})", "DB")
+
+            main.main_menu()
         else:
-            log("❌ main_menu не найден в sshscree.py", "CRASH")
+            log("❌ main_menu не найден в main.py", "CRASH")
             sys.exit(1)
 
         duration = time.time() - start_time
@@ -98,4 +271,8 @@ if __name__ == "__main__":
         traceback.print_exc()
         print(f"\033[91m[DEBUG] КРИТ: {e}\033[0m")
 
+    if tracer:
+        tracer.close()
+        report(tracer)
     log("=== СЕССИЯ ЗАВЕРШЕНА ===", "EXIT")
+    _log_writer.close()
@@ -1,319 +1,2399 @@
 import os
-import paramiko
+import stat
+import time
+import json
+import shlex
+import hashlib
+import tarfile
+import select
+import selectors
+import socket
+import base64
+import codecs
+import contextlib
+import fnmatch
+import posixpath
+import re
+import uuid
+import importlib
+import threading
 import sqlite3
-from cryptography.fernet import Fernet
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import deque
+try: import readline
+except ImportError: readline = None
 from rich.console import Console
 from rich.prompt import Prompt, Confirm
-from rich.table import Table
-from rich.panel import Panel
-from rich import box
+from rich.text import Text
+
+# отложенный импорт: модуль (или имя из него) загружается при первом обращении,
+# поэтому меню появляется сразу, а paramiko и cryptography грузятся, когда понадобятся
+class Lazy:
+    def __init__(self, module, name=None):
+        self._module = module
+        self._name = name
+        self._target = None
+        self._hooks = []
+        self._lock = threading.RLock()
+
+    def load(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    module = importlib.import_module(self._module)
+                    for hook in self._hooks: hook(module)
+                    self._target = getattr(module, self._name) if self._name else module
+        return self._target
+
+    # fn(модуль) сразу после загрузки; если модуль уже загружен — немедленно
+    def when_loaded(self, fn):
+        with self._lock:
+            if self._target is None:
+                self._hooks.append(fn)
+                return
+        fn(importlib.import_module(self._module))
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+paramiko = Lazy("paramiko")
+fernet = Lazy("cryptography.fernet")
+hashes = Lazy("cryptography.hazmat.primitives.hashes")
+PBKDF2HMAC = Lazy("cryptography.hazmat.primitives.kdf.pbkdf2", "PBKDF2HMAC")
+Table = Lazy("rich.table", "Table")
+Panel = Lazy("rich.panel", "Panel")
+Live = Lazy("rich.live", "Live")
+Progress = Lazy("rich.progress", "Progress")
+TextColumn = Lazy("rich.progress", "TextColumn")
+BarColumn = Lazy("rich.progress", "BarColumn")
+DownloadColumn = Lazy("rich.progress", "DownloadColumn")
+TransferSpeedColumn = Lazy("rich.progress", "TransferSpeedColumn")
+TimeRemainingColumn = Lazy("rich.progress", "TimeRemainingColumn")
+box = Lazy("rich.box")
 
 console = Console()
 DB_FILE = "servers.db"
 HISTORY_FILE = "local_history.txt"
+KEY_FILE = "secret.key"
+HISTORY_LIMIT = 10000
+HISTORY_FLUSH = 20
+HISTORY_SHOW = 50
+HISTORY_READLINE = 1000
+PATH_CACHE_TTL = 30
+FORWARD_BUFFER = 256 * 1024
+FORWARD_OPEN_WORKERS = 4
+# команды, после которых дерево файлов на сервере заведомо не меняется (если нет перенаправления в файл)
+READONLY_COMMANDS = {"ls", "ll", "cd", "pwd", "cat", "less", "more", "head", "tail", "grep", "egrep", "find", "stat",
+                     "file", "du", "df", "free", "uptime", "whoami", "id", "which", "type", "echo", "printf", "env",
+                     "ps", "top", "htop", "uname", "hostname", "date", "history", "wc", "md5sum", "sha256sum",
+                     "journalctl", "systemctl", "ip", "ss", "netstat", "ping", "tree", "clear"}
+FILE_OPTIONS = ["sync", "ls", "-j", "--tar", "--no-tar", "-z", "--delete", "--dry-run", "--hash"]
+REPL_COMMANDS = ["exit", "infovds", "file", "forward", "tune", "clear", "cls", "cd", "local ls", "local history", "dash", "undash"]
+KDF_ITERATIONS = 600000
 VERSION = "v0.1.2"
+TRANSFER_WORKERS = 4
+FACTS_TTL = 24 * 3600
+INFO_WATCH_INTERVAL = 2
+OUTPUT_FLUSH_INTERVAL = 0.05
+OUTPUT_FLUSH_BYTES = 64 * 1024
+SHELL_CANCEL_TIMEOUT = 3
+CHANNEL_OPEN_TIMEOUT = 10
+POOL_IDLE_TIMEOUT = 15 * 60
+POOL_KEEPALIVE = 30
+POOL_VERIFY_IDLE = 60
+PREWARM_SERVERS = 3
+FANOUT_WORKERS = 16
+FANOUT_TIMEOUT = 30
+FANOUT_OUTPUT_LIMIT = 64 * 1024
+FANOUT_PREVIEW_LINES = 20
+INVENTORY_PAGE = 20
+STATIC_FACTS = ["cpu_model", "cpu_cores", "os_name", "hostname"]
+DYNAMIC_FACTS = ["ip", "mem_used", "mem_total", "disk", "load", "uptime"]
+INFO_STATIC_PROBE = r"""
+echo "cpu_model=$(lscpu 2>/dev/null | grep 'Model name' | cut -d ':' -f2 | xargs)"
+echo "cpu_cores=$(nproc 2>/dev/null)"
+echo "os_name=$(grep PRETTY_NAME /etc/os-release 2>/dev/null | cut -d '"' -f2)"
+echo "hostname=$(hostname 2>/dev/null)"
+"""
+INFO_DYNAMIC_PROBE = r"""
+echo "ip=$(hostname -I 2>/dev/null | awk '{print $1}')"
+free -h 2>/dev/null | awk '/Mem/ {print "mem_used=" $3; print "mem_total=" $2}'
+df -h / 2>/dev/null | tail -1 | awk '{print "disk=" $3 " / " $2 " (" $5 ")"}'
+echo "load=$(uptime | awk -F'load average:' '{print $2}' | xargs)"
+echo "uptime=$(uptime -p 2>/dev/null)"
+"""
+RANGE_THRESHOLD = 64 * 1024 * 1024
+RANGE_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 32768
+PART_SUFFIX = ".sshscre-part"
+SYNC_PREVIEW = 50
+TAR_MIN_FILES = 32
+TAR_AVG_SIZE = 64 * 1024
+WALK_WORKERS = 8
+TAR_EXTRACT_ARGS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+PROVISION_TIMEOUT = 15 * 60
+DASH_INTERVAL = 2
+DASH_HISTORY = 60
+DASH_DISK_EVERY = 5
+DASH_LINE_LIMIT = 4096
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+# семплер мониторинга: один процесс awk на сервер читает /proc раз в interval секунд.
+# Счётчики (ЦПУ всего/простой, байты сети) отдаются приращениями, показатели
+# (память, load, диск) — только когда изменились; диск читается раз в every семплов.
+# Числа печатаются через %.0f: mawk выводит большие целые в экспоненциальной записи
+DASH_SAMPLER = r"""
+function num(x) { return sprintf("%.0f", x) }
+function emit(key, value) { if (last[key] != value "") { out = out " " key "=" value; last[key] = value "" } }
+BEGIN {
+    for (n = 0; ; n++) {
+        out = ""
+        getline line < "/proc/stat"; close("/proc/stat")
+        k = split(line, f, " "); total = 0
+        for (i = 2; i <= k; i++) total += f[i]
+        idle = f[5] + f[6]
+        rx = tx = 0
+        while ((getline line < "/proc/net/dev") > 0) {
+            if (line !~ /:/) continue
+            sub(/^ +/, "", line); split(line, h, ":")
+            if (h[1] == "lo") continue
+            split(h[2], f, " "); rx += f[1]; tx += f[9]
+        }
+        close("/proc/net/dev")
+        if (n) out = " c=" num(total - ptotal) " i=" num(idle - pidle) " r=" num(rx - prx) " t=" num(tx - ptx)
+        ptotal = total; pidle = idle; prx = rx; ptx = tx
+        while ((getline line < "/proc/meminfo") > 0) {
+            split(line, f, " ")
+            if (f[1] == "MemTotal:") mt = f[2]; else if (f[1] == "MemAvailable:") ma = f[2]
+        }
+        close("/proc/meminfo")
+        emit("M", num(mt)); emit("m", num(mt - ma))
+        getline line < "/proc/loadavg"; close("/proc/loadavg")
+        split(line, f, " "); emit("l", f[1])
+        if (n % every == 0) {
+            cmd = "df -Pk / | tail -n 1"; cmd | getline line; close(cmd)
+            split(line, f, " "); emit("D", num(f[2])); emit("d", num(f[3]))
+        }
+        print substr(out, 2); fflush()
+        system("sleep " interval)
+    }
+}
+"""
+TUNE_BYTES = 32 * 1024 * 1024
+TUNE_SECONDS = 3
+TUNE_PINGS = 3
+TUNE_MARGIN = 1.05
+TUNE_LATENCY_MARGIN = 1.2
+TUNE_LATENCY_SLACK = 0.005
+TUNE_WINDOWS = [2 * 1024 * 1024, 8 * 1024 * 1024, 32 * 1024 * 1024]
+TUNE_PACKETS = [32768, 131072]
+TUNE_CIPHERS = ["aes128-ctr", "aes256-ctr", "aes128-gcm@openssh.com", "aes256-gcm@openssh.com"]
+# поток для замера: 256 КБ случайных данных в base64 повторяются до нужного объёма (сжимаемость как у текста)
+TUNE_STREAM = 'b=$(head -c 262144 /dev/urandom | base64); while :; do printf "%s\\n" "$b"; done | head -c {size}'
+# шаги настройки: check с кодом 0 значит, что шаг уже выполнен; {sudo} пустой для root
+PROVISION_STEPS = [
+    {"name": "apt_update", "title": "Обновление списка пакетов",
+     "run": "{sudo} apt-get update -y"},
+    {"name": "packages", "title": "Установка ufw, nginx, git", "needs": ["apt_update"],
+     "check": "dpkg -s ufw nginx software-properties-common git >/dev/null 2>&1",
+     "run": "{sudo} env DEBIAN_FRONTEND=noninteractive apt-get install -y ufw nginx software-properties-common git"},
+    {"name": "firewall", "title": "Настройка ufw", "needs": ["packages"],
+     "check": "{sudo} ufw status | grep -q 'Status: active' && {sudo} ufw status | grep -q '^9339'",
+     "run": "{sudo} ufw allow 22 && {sudo} ufw allow 9339 && {sudo} ufw --force enable"},
+    {"name": "nginx", "title": "Запуск nginx", "needs": ["packages"],
+     "check": "systemctl is-enabled --quiet nginx && systemctl is-active --quiet nginx",
+     "run": "{sudo} systemctl enable nginx && {sudo} systemctl start nginx"},
+    {"name": "catrobat_ppa", "title": "Репозиторий catrobat", "needs": ["packages"], "optional": True,
+     "check": "ls /etc/apt/sources.list.d/ 2>/dev/null | grep -q catrobat",
+     "run": "{sudo} add-apt-repository ppa:catrobat/ppa -y"},
+    {"name": "catrobat", "title": "Установка catrobat", "needs": ["catrobat_ppa"], "optional": True,
+     "check": "dpkg -s catrobat >/dev/null 2>&1",
+     "run": "{sudo} apt-get update -y && {sudo} env DEBIAN_FRONTEND=noninteractive apt-get install -y catrobat"},
+    {"name": "clone_v28", "title": "Клонирование KSD-Brawl-V28 в v28", "needs": ["packages"],
+     "check": "test -d v28/.git",
+     "run": "git clone https://github.com/justflyne/KSD-Brawl-V28 v28"},
+]
+
+# хранилище ключа: шифр создаётся один раз на процесс; ключ либо лежит в файле,
+# либо выводится из мастер-пароля через PBKDF2 (в файле тогда только соль и проверочный токен)
+class Vault:
+    def __init__(self, key_file=KEY_FILE):
+        self.key_file = key_file
+        self.lock = threading.Lock()
+        self.cipher = None
 
-# ключ шифрования
-def get_encryption_key():
-    key_file = "secret.key"
-    if os.path.exists(key_file):
-        with open(key_file, "rb") as f: return f.read()
-    key = Fernet.generate_key()
-    with open(key_file, "wb") as f: f.write(key)
-    return key
+    @staticmethod
+    def derive(passphrase, salt, iterations=KDF_ITERATIONS):
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=iterations)
+        return base64.urlsafe_b64encode(kdf.derive(passphrase.encode()))
+
+    def protected(self):
+        if not os.path.exists(self.key_file): return False
+        with open(self.key_file, "rb") as f: return f.read(1) == b"{"
+
+    # ключ из файла или из мастер-пароля; запрашивается при первом обращении
+    def unlock(self):
+        with self.lock:
+            if self.cipher: return self.cipher
+            if not os.path.exists(self.key_file):
+                key = fernet.Fernet.generate_key()
+                self._write(key)
+                self.cipher = fernet.Fernet(key)
+                return self.cipher
+            with open(self.key_file, "rb") as f: data = f.read()
+            if not data.startswith(b"{"):
+                self.cipher = fernet.Fernet(data.strip())
+                return self.cipher
+            meta = json.loads(data)
+            salt = base64.b64decode(meta["salt"])
+            for _ in range(3):
+                cipher = fernet.Fernet(self.derive(Prompt.ask("🔐 Мастер-пароль", password=True), salt, meta["iterations"]))
+                try: cipher.decrypt(meta["check"].encode())
+                except fernet.InvalidToken:
+                    console.print("❌ Неверный мастер-пароль", style="red")
+                    continue
+                self.cipher = cipher
+                return cipher
+            raise PermissionError("хранилище паролей не разблокировано")
+
+    def encrypt(self, text):
+        return self.unlock().encrypt(text.encode()).decode()
+
+    def decrypt(self, token):
+        return self.unlock().decrypt(token.encode()).decode()
+
+    # пароль расшифровывается только при подключении
+    def password(self, server):
+        if server.get("password"): return server["password"]
+        return self.decrypt(server["secret"]) if server.get("secret") else None
+
+    # смена ключа: все пароли перешифровываются одной транзакцией, старый ключ остаётся в .bak
+    def rotate(self, passphrase=None):
+        old = self.unlock()
+        if passphrase:
+            salt = os.urandom(16)
+            key = self.derive(passphrase, salt)
+            cipher = fernet.Fernet(key)
+            data = json.dumps({"kdf": "pbkdf2-sha256", "iterations": KDF_ITERATIONS, "salt": base64.b64encode(salt).decode(), "check": cipher.encrypt(b"sshscre").decode()}).encode()
+        else:
+            key = data = fernet.Fernet.generate_key()
+            cipher = fernet.Fernet(key)
+        with db.batch() as conn:
+            rows = conn.execute("SELECT id, password FROM servers WHERE password IS NOT NULL AND password != ''").fetchall()
+            conn.executemany("UPDATE servers SET password = ? WHERE id = ?", [(cipher.encrypt(old.decrypt(row["password"].encode())).decode(), row["id"]) for row in rows])
+            backup = self.key_file + ".bak"
+            if os.path.exists(self.key_file): os.replace(self.key_file, backup)
+            try: self._write(data)
+            except OSError:
+                if os.path.exists(backup): os.replace(backup, self.key_file)
+                raise
+        with self.lock: self.cipher = cipher
+        return len(rows)
+
+    def _write(self, data):
+        tmp = self.key_file + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f: f.write(data)
+        os.replace(tmp, self.key_file)
+
+vault = Vault()
 
 # шифрование пароля
 def encrypt_password(password):
-    key = get_encryption_key()
-    return Fernet(key).encrypt(password.encode()).decode()
-
-# дешифрование пароля
-def decrypt_password(encrypted):
-    key = get_encryption_key()
-    return Fernet(key).decrypt(encrypted.encode()).decode()
-
-# инициализация БД
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    return vault.encrypt(password)
+
+# миграции схемы БД: номер версии = индекс + 1, применённая версия хранится в PRAGMA user_version
+SERVER_COLUMNS = [("name", "TEXT"), ("host", "TEXT"), ("user", "TEXT"), ("password", "TEXT"), ("os", "TEXT"),
+                  ("setup_done", "INTEGER"), ("auth_type", "TEXT DEFAULT 'password'"), ("key_path", "TEXT")]
+
+def _migrate_base(c):
+    c.execute("CREATE TABLE IF NOT EXISTS servers (id INTEGER PRIMARY KEY AUTOINCREMENT)")
+    present = {col[1] for col in c.execute("PRAGMA table_info(servers)")}
+    for column, kind in SERVER_COLUMNS:
+        if column not in present: c.execute(f"ALTER TABLE servers ADD COLUMN {column} {kind}")
     c.execute('''
-        CREATE TABLE IF NOT EXISTS servers (
+        CREATE TABLE IF NOT EXISTS sessions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT,
-            host TEXT,
-            user TEXT,
-            password TEXT,
-            os TEXT,
-            setup_done INTEGER,
-            auth_type TEXT,
-            key_path TEXT
+            server_id INTEGER,
+            cwd TEXT,
+            FOREIGN KEY(server_id) REFERENCES servers(id)
         )
     ''')
+
+def _migrate_extras(c):
     c.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
+        CREATE TABLE IF NOT EXISTS server_tags (
+            server_id INTEGER,
+            tag TEXT,
+            FOREIGN KEY(server_id) REFERENCES servers(id)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS server_facts (
+            server_id INTEGER PRIMARY KEY,
+            data TEXT,
+            updated REAL,
+            FOREIGN KEY(server_id) REFERENCES servers(id)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS provision_steps (
+            server_id INTEGER,
+            step TEXT,
+            done REAL,
+            PRIMARY KEY(server_id, step),
+            FOREIGN KEY(server_id) REFERENCES servers(id)
+        )
+    ''')
+
+def _migrate_indexes(c):
+    # дубликаты от старого save_session и сессии удалённых серверов мешают уникальному индексу
+    c.execute("DELETE FROM sessions WHERE id NOT IN (SELECT MAX(id) FROM sessions GROUP BY name)")
+    c.execute("DELETE FROM sessions WHERE server_id NOT IN (SELECT id FROM servers)")
+    c.execute("DELETE FROM server_tags WHERE rowid NOT IN (SELECT MIN(rowid) FROM server_tags GROUP BY server_id, tag)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_name ON sessions(name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_server ON sessions(server_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_server_tags ON server_tags(server_id, tag)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_server_tags_tag ON server_tags(tag)")
+
+def _migrate_inventory(c):
+    c.execute("ALTER TABLE servers ADD COLUMN grp TEXT DEFAULT ''")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_servers_grp ON servers(grp)")
+
+def _migrate_history(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
             server_id INTEGER,
+            cmd TEXT,
+            ts REAL
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_server ON history(server_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_cmd ON history(server_id, cmd)")
+    # старый общий файл истории переносится без привязки к серверу
+    if os.path.exists(HISTORY_FILE):
+        with open(HISTORY_FILE, errors="replace") as f: lines = [line.rstrip("\n") for line in f if line.strip()]
+        ts = os.path.getmtime(HISTORY_FILE)
+        c.executemany("INSERT INTO history (server_id, cmd, ts) VALUES (NULL, ?, ?)", [(line, ts) for line in lines[-HISTORY_LIMIT:]])
+
+def _migrate_connect(c):
+    c.execute("ALTER TABLE servers ADD COLUMN show_info INTEGER DEFAULT 1")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS server_state (
+            server_id INTEGER PRIMARY KEY,
+            hostname TEXT,
+            home TEXT,
             cwd TEXT,
+            updated REAL,
             FOREIGN KEY(server_id) REFERENCES servers(id)
         )
     ''')
-    conn.commit()
-    conn.close()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS connect_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            ts REAL,
+            to_prompt REAL,
+            warm INTEGER
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_connect_metrics_server ON connect_metrics(server_id, ts)")
 
-# проверка структуры БД
-def check_db_structure():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    # проверка таблицы servers
-    c.execute("PRAGMA table_info(servers)")
-    columns = [col[1] for col in c.fetchall()]
-    desired = ["id", "name", "host", "user", "password", "os", "setup_done", "auth_type", "key_path"]
-    if sorted(columns) != sorted(desired):
-        conn.close()
-        return False
-    
-    # проверка таблицы sessions
-    c.execute("PRAGMA table_info(sessions)")
-    columns = [col[1] for col in c.fetchall()]
-    desired = ["id", "name", "server_id", "cwd"]
-    if sorted(columns) != sorted(desired):
-        conn.close()
-        return False
-    
-    conn.close()
-    return True
+def _migrate_transport(c):
+    c.execute("ALTER TABLE servers ADD COLUMN transport TEXT")
+
+# нечёткий LIKE и сортировка по instr индексами по имени и хосту не пользуются, а запись они замедляют
+def _migrate_search_indexes(c):
+    c.execute("DROP INDEX IF EXISTS idx_servers_name")
+    c.execute("DROP INDEX IF EXISTS idx_servers_host")
+
+MIGRATIONS = [_migrate_base, _migrate_extras, _migrate_indexes, _migrate_inventory, _migrate_history, _migrate_connect, _migrate_transport, _migrate_search_indexes]
+
+# экранирование спецсимволов LIKE (ESCAPE '\')
+def like_escape(text):
+    return "".join("\\" + ch if ch in "%_\\" else ch for ch in text)
+
+# шаблон LIKE для нечёткого поиска: символы запроса по порядку, между ними что угодно
+def fuzzy_pattern(text):
+    return "%" + "%".join(like_escape(ch) for ch in text) + "%"
+
+INVENTORY_COLUMNS = "id, name, host, user, os, setup_done, auth_type, key_path, grp, show_info, transport"
+
+# хранилище: одно соединение на процесс в режиме WAL, запись одной строкой, пакетные транзакции
+class Database:
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self.conn = None
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.migrated = None
+
+    # соединение открывается при первом обращении, схема сразу доводится до актуальной
+    def connect(self):
+        with self.lock:
+            if self.conn is None:
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA foreign_keys=ON")
+                self.conn = conn
+                self.migrated = self.migrate()
+            return self.conn
 
-# загрузка серверов
-def load_servers():
-    init_db()
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM servers")
-    servers = []
-    for row in c.fetchall():
-        server = {
-            "id": row[0],
-            "name": row[1],
-            "host": row[2],
-            "user": row[3],
-            "password": decrypt_password(row[4]) if row[4] else None,
-            "os": row[5],
-            "setup_done": bool(row[6]),
-            "auth_type": row[7],
-            "key_path": row[8]
+    # применение недостающих миграций; возвращает (было, стало)
+    def migrate(self):
+        with self.lock:
+            current = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            for version, step in enumerate(MIGRATIONS[current:], current + 1):
+                with self.batch():
+                    step(self.conn)
+                    self.conn.execute(f"PRAGMA user_version = {version}")
+            return current, len(MIGRATIONS)
+
+    # несколько записей одной транзакцией; вложенные batch() присоединяются к внешнему
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            conn = self.conn or self.connect()
+            if not self.depth: conn.execute("BEGIN IMMEDIATE")
+            self.depth += 1
+            try: yield conn
+            except BaseException:
+                self.depth -= 1
+                if not self.depth: conn.execute("ROLLBACK")
+                raise
+            self.depth -= 1
+            if not self.depth: conn.execute("COMMIT")
+
+    def query(self, sql, args=()):
+        with self.lock: return self.connect().execute(sql, args).fetchall()
+
+    def execute(self, sql, args=()):
+        with self.batch() as conn: return conn.execute(sql, args)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None: self.conn.close()
+            self.conn = None
+
+    # серверы
+    def _tags(self, ids=None):
+        if ids is None: rows = self.query("SELECT server_id, tag FROM server_tags ORDER BY rowid")
+        else: rows = self.query(f"SELECT server_id, tag FROM server_tags WHERE server_id IN ({','.join('?' * len(ids))}) ORDER BY rowid", ids)
+        tags = {}
+        for row in rows: tags.setdefault(row["server_id"], []).append(row["tag"])
+        return tags
+
+    # строка без пароля
+    @staticmethod
+    def _server(row, tags):
+        return {
+            "id": row["id"],
+            "name": row["name"],
+            "host": row["host"],
+            "user": row["user"],
+            "os": row["os"],
+            "setup_done": bool(row["setup_done"]),
+            "auth_type": row["auth_type"],
+            "key_path": row["key_path"],
+            "group": row["grp"] or "",
+            "show_info": row["show_info"] is None or bool(row["show_info"]),
+            "transport": json.loads(row["transport"]) if row["transport"] else {},
+            "tags": tags.get(row["id"], [])
         }
-        servers.append(server)
-    conn.close()
-    return servers
-
-# сохранение серверов
-def save_servers(servers):
-    init_db()
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM servers")
-    for server in servers:
-        encrypted_pass = encrypt_password(server["password"]) if server.get("password") else None
-        c.execute('''
-            INSERT INTO servers (name, host, user, password, os, setup_done, auth_type, key_path)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            server["name"],
-            server["host"],
-            server["user"],
-            encrypted_pass,
-            server["os"],
-            int(server["setup_done"]),
-            server["auth_type"],
-            server.get("key_path", "")
-        ))
-    conn.commit()
-    conn.close()
-
-# загрузка сессий
-def load_sessions():
-    init_db()
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT sessions.name, servers.id, sessions.cwd FROM sessions JOIN servers ON sessions.server_id = servers.id")
-    sessions = {}
-    for row in c.fetchall():
-        sessions[row[0]] = {"server_id": row[1], "cwd": row[2]}
-    conn.close()
-    return sessions
+
+    def servers(self):
+        tags = self._tags()
+        servers = []
+        for row in self.query("SELECT * FROM servers ORDER BY id"):
+            server = self._server(row, tags)
+            server["secret"] = row["password"]
+            servers.append(server)
+        return servers
+
+    # один сервер со всеми данными для подключения; пароль остаётся зашифрованным до connect
+    def server(self, server_id):
+        rows = self.query("SELECT * FROM servers WHERE id = ?", (server_id,))
+        if not rows: return None
+        server = self._server(rows[0], self._tags([server_id]))
+        server["secret"] = rows[0]["password"]
+        return server
+
+    # страница инвентаря по фильтрам; возвращает (строки без паролей, всего подходящих)
+    def inventory(self, text=None, tag=None, group=None, offset=0, limit=None):
+        where, args, order, order_args = [], [], "id", []
+        if text:
+            where.append("(name LIKE ? ESCAPE '\\' OR host LIKE ? ESCAPE '\\')")
+            args += [fuzzy_pattern(text)] * 2
+            # сначала совпадения с начала имени, затем подстрокой, затем по хосту и остальные
+            order = "CASE WHEN name LIKE ? ESCAPE '\\' THEN 0 WHEN instr(lower(name), lower(?)) THEN 1 WHEN instr(host, ?) THEN 2 ELSE 3 END, length(name), name"
+            order_args = [like_escape(text) + "%", text, text]
+        if tag:
+            where.append("id IN (SELECT server_id FROM server_tags WHERE tag = ?)")
+            args.append(tag)
+        if group is not None:
+            where.append("grp = ?")
+            args.append(group)
+        clause = " WHERE " + " AND ".join(where) if where else ""
+        total = self.query(f"SELECT COUNT(*) FROM servers{clause}", args)[0][0]
+        rows = self.query(f"SELECT {INVENTORY_COLUMNS} FROM servers{clause} ORDER BY {order} LIMIT ? OFFSET ?", args + order_args + [-1 if limit is None else limit, offset])
+        tags = self._tags([row["id"] for row in rows]) if rows else {}
+        return [self._server(row, tags) for row in rows], total
+
+    # количество серверов по тегам и группам
+    def labels(self):
+        tags = [(row[0], row[1]) for row in self.query("SELECT tag, COUNT(*) FROM server_tags GROUP BY tag ORDER BY tag")]
+        groups = [(row[0], row[1]) for row in self.query("SELECT grp, COUNT(*) FROM servers WHERE grp != '' GROUP BY grp ORDER BY grp")]
+        return tags, groups
+
+    # вставка или обновление одной строки; новый сервер получает id
+    def save_server(self, server):
+        encrypted_pass = encrypt_password(server["password"]) if server.get("password") else server.get("secret")
+        server["secret"] = encrypted_pass
+        with self.batch() as conn:
+            c = conn.execute('''
+                INSERT INTO servers (id, name, host, user, password, os, setup_done, auth_type, key_path, grp, show_info, transport)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET name = excluded.name, host = excluded.host, user = excluded.user,
+                    password = excluded.password, os = excluded.os, setup_done = excluded.setup_done,
+                    auth_type = excluded.auth_type, key_path = excluded.key_path, grp = excluded.grp,
+                    show_info = excluded.show_info, transport = excluded.transport
+            ''', (
+                server.get("id"),
+                server["name"],
+                server["host"],
+                server["user"],
+                encrypted_pass,
+                server["os"],
+                int(server["setup_done"]),
+                server["auth_type"],
+                server.get("key_path", ""),
+                server.get("group", ""),
+                int(server.get("show_info", True)),
+                json.dumps(server["transport"]) if server.get("transport") else None
+            ))
+            if not server.get("id"): server["id"] = c.lastrowid
+            self.set_tags(server["id"], server.get("tags", []))
+        return server["id"]
+
+    def set_tags(self, server_id, tags):
+        with self.batch() as conn:
+            conn.execute("DELETE FROM server_tags WHERE server_id = ?", (server_id,))
+            conn.executemany("INSERT OR IGNORE INTO server_tags (server_id, tag) VALUES (?, ?)", [(server_id, tag) for tag in tags])
+
+    def set_setup_done(self, server_id, done=True):
+        self.execute("UPDATE servers SET setup_done = ? WHERE id = ?", (int(done), server_id))
+
+    def set_show_info(self, server_id, show=True):
+        self.execute("UPDATE servers SET show_info = ? WHERE id = ?", (int(show), server_id))
+
+    # профиль транспорта после tune; пустой — настройки paramiko по умолчанию
+    def set_transport(self, server_id, profile):
+        self.execute("UPDATE servers SET transport = ? WHERE id = ?", (json.dumps(profile) if profile else None, server_id))
+
+    # имя хоста, домашний и последний каталог с прошлого подключения
+    def server_state(self, server_id):
+        rows = self.query("SELECT hostname, home, cwd FROM server_state WHERE server_id = ?", (server_id,))
+        return dict(rows[0]) if rows else {}
+
+    def save_server_state(self, server_id, **state):
+        state = {k: v for k, v in state.items() if v}
+        if not state: return
+        columns = ", ".join(state)
+        updates = ", ".join(f"{k} = excluded.{k}" for k in state)
+        self.execute(f"INSERT INTO server_state (server_id, {columns}, updated) VALUES (?, {', '.join('?' * len(state))}, ?) "
+                     f"ON CONFLICT(server_id) DO UPDATE SET {updates}, updated = excluded.updated", (server_id, *state.values(), time.time()))
+
+    # серверы, к которым подключались последними
+    def recent_servers(self, limit):
+        rows = self.query("SELECT server_id FROM connect_metrics GROUP BY server_id ORDER BY MAX(ts) DESC LIMIT ?", (limit,))
+        return [server for server in (self.server(row[0]) for row in rows) if server]
+
+    # время от начала подключения до промпта
+    def record_connect(self, server_id, to_prompt, warm):
+        self.execute("INSERT INTO connect_metrics (server_id, ts, to_prompt, warm) VALUES (?, ?, ?, ?)", (server_id, time.time(), to_prompt, int(warm)))
+
+    # сессии
+    def save_session(self, name, server_id, cwd):
+        self.execute('''
+            INSERT INTO sessions (name, server_id, cwd) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET server_id = excluded.server_id, cwd = excluded.cwd
+        ''', (name, server_id, cwd))
+
+    # выполненные шаги настройки
+    def provisioned(self, server_id):
+        return {row["step"] for row in self.query("SELECT step FROM provision_steps WHERE server_id = ?", (server_id,))}
+
+    def mark_provisioned(self, server_id, step):
+        self.execute("INSERT OR REPLACE INTO provision_steps (server_id, step, done) VALUES (?, ?, ?)", (server_id, step, time.time()))
+
+    def reset_provisioned(self, server_id):
+        self.execute("DELETE FROM provision_steps WHERE server_id = ?", (server_id,))
+
+    # кеш статичных фактов о сервере (ЦПУ, ОС, имя)
+    def facts(self, server_id):
+        rows = self.query("SELECT data, updated FROM server_facts WHERE server_id = ?", (server_id,))
+        return (json.loads(rows[0]["data"]), rows[0]["updated"]) if rows else None
+
+    def save_facts(self, server_id, facts):
+        self.execute("INSERT OR REPLACE INTO server_facts (server_id, data, updated) VALUES (?, ?, ?)", (server_id, json.dumps(facts), time.time()))
+
+db = Database()
+
+# история команд сервера: запись пачками, повтор команды переносит её в конец, размер ограничен
+class History:
+    def __init__(self, server_id, limit=HISTORY_LIMIT):
+        self.server_id = server_id
+        self.limit = limit
+        self.buffer = []
+        self.last = None
+
+    def add(self, cmd):
+        if cmd == self.last: return
+        self.last = cmd
+        self.buffer.append((cmd, time.time()))
+        if len(self.buffer) >= HISTORY_FLUSH: self.flush()
+
+    def flush(self):
+        if not self.buffer: return
+        with db.batch() as conn:
+            for cmd, ts in self.buffer:
+                conn.execute("DELETE FROM history WHERE server_id = ? AND cmd = ?", (self.server_id, cmd))
+                conn.execute("INSERT INTO history (server_id, cmd, ts) VALUES (?, ?, ?)", (self.server_id, cmd, ts))
+            conn.execute('''
+                DELETE FROM history WHERE server_id = ? AND id <= (
+                    SELECT id FROM history WHERE server_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)
+            ''', (self.server_id, self.server_id, self.limit))
+        self.buffer = []
+
+    # последние записи; pattern — подстрока, ^pattern — начало команды; everywhere — все серверы
+    def search(self, pattern=None, limit=HISTORY_SHOW, everywhere=False):
+        self.flush()
+        where, args = ["1"], []
+        if not everywhere: where, args = ["server_id = ?"], [self.server_id]
+        if pattern and pattern.startswith("^"):
+            where.append("cmd >= ? AND cmd < ?")
+            args += [pattern[1:], pattern[1:] + "\U0010ffff"]
+        elif pattern:
+            where.append("instr(cmd, ?) > 0")
+            args.append(pattern)
+        rows = db.query(f"SELECT id, server_id, cmd, ts FROM history WHERE {' AND '.join(where)} ORDER BY id DESC LIMIT ?", args + [limit])
+        return rows[::-1]
+
+    # !n — запись по номеру, !! — последняя, !текст — последняя, начинающаяся с текста
+    def expand(self, cmd):
+        self.flush()
+        if cmd == "!!": rows = db.query("SELECT cmd FROM history WHERE server_id = ? ORDER BY id DESC LIMIT 1", (self.server_id,))
+        elif cmd[1:].isdigit(): rows = db.query("SELECT cmd FROM history WHERE id = ? AND (server_id = ? OR server_id IS NULL)", (int(cmd[1:]), self.server_id))
+        else: rows = db.query("SELECT cmd FROM history WHERE server_id = ? AND cmd >= ? AND cmd < ? ORDER BY id DESC LIMIT 1", (self.server_id, cmd[1:], cmd[1:] + "\U0010ffff"))
+        return rows[0]["cmd"] if rows else None
+
+    # стрелки вверх/вниз листают историю этого сервера
+    def attach_readline(self):
+        if not readline: return
+        readline.clear_history()
+        for row in self.search(limit=HISTORY_READLINE): readline.add_history(row["cmd"])
+
+    def detach_readline(self):
+        self.flush()
+        if readline: readline.clear_history()
+
+# вывод найденных записей истории с номерами для !n
+def show_history(history, args):
+    everywhere = "--all" in args.split()
+    pattern = args.replace("--all", "").strip()
+    if pattern.startswith("grep"): pattern = pattern[4:].strip()
+    rows = history.search(pattern or None, everywhere=everywhere)
+    if not rows:
+        console.print("История команд пуста" if not pattern else "Ничего не найдено", style="yellow")
+        return
+    names = {}
+    if everywhere: names = {row["id"]: row["name"] for row in db.query("SELECT id, name FROM servers")}
+    for row in rows:
+        when = time.strftime("%d.%m %H:%M", time.localtime(row["ts"]))
+        where = f" [{names.get(row['server_id'], '—')}]" if everywhere else ""
+        console.print(f"{row['id']:>6}  {when}{where}  {row['cmd']}", markup=False, highlight=False)
 
 # сохранение сессии
 def save_session(name, server, cwd):
-    init_db()
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id FROM sessions WHERE name = ?", (name,))
-    if c.fetchone():
-        c.execute("UPDATE sessions SET server_id = ?, cwd = ? WHERE name = ?", (server["id"], cwd, name))
-    else:
-        c.execute("INSERT INTO sessions (name, server_id, cwd) VALUES (?, ?, ?)", (name, server["id"], cwd))
-    conn.commit()
-    conn.close()
-
-# настройка сервера
-def setup_server(ssh, os_type):
-    run = lambda c: ssh.exec_command(c)
-    run("sudo apt update -y")
-    run("sudo apt install -y ufw nginx software-properties-common git")
-    run("sudo ufw allow 22 && sudo ufw allow 9339 && sudo ufw --force enable")
-    run("sudo systemctl enable nginx && sudo systemctl start nginx")
-    run("sudo add-apt-repository ppa:catrobat/ppa -y 2>/dev/null || true")
-    run("sudo apt update && sudo apt install -y catrobat || true")
-    run("git clone https://github.com/justflyne/KSD-Brawl-V28 v28")
-    console.print("✅ Репозиторий KSD-Brawl-V28 склонирован в папку v28", style="green")
-    console.print("✅ Настройка завершена", style="green")
+    db.save_session(name, server["id"], cwd)
 
-# показ информации о сервере
-def show_infovds(ssh):
-    run = lambda c: ssh.exec_command(c)[1].read().decode().strip()
+# скрипт-проба печатает строки key=value; канал открывается с таймаутом,
+# а если соединение сервера не отвечает — один раз через переподключение в пуле
+def run_probe(ssh, script, server=None):
+    try: chan = ssh.get_transport().open_session(timeout=CHANNEL_OPEN_TIMEOUT)
+    except (paramiko.SSHException, EOFError, OSError):
+        if not server: raise
+        chan = pool.replace(server, ssh).get_transport().open_session(timeout=CHANNEL_OPEN_TIMEOUT)
     try:
-        cpu_model = run('lscpu | grep "Model name" | cut -d ":" -f2 | xargs') or "N/A"
-        cpu_cores = run('nproc') or "N/A"
-        mem_used = run('free -h | awk \'/Mem/ {print $3}\'') or "N/A"
-        mem_total = run('free -h | awk \'/Mem/ {print $2}\'') or "N/A"
-        disk = run('df -h / | tail -1 | awk \'{print $3" / "$2" ("$5")"}\'') or "N/A"
-        load = run("uptime | awk -F'load average:' '{print $2}'").strip() or "N/A"
-        ip = run("hostname -I | awk '{print $1}'") or "N/A"
-        os_name = run('cat /etc/os-release | grep PRETTY_NAME | cut -d \'"\' -f2') or "N/A"
-        hostname = run("hostname") or "N/A"
-    except Exception as e:
-        console.print(f"❌ Ошибка получения данных: {e}", style="red")
-        cpu_model = cpu_cores = mem_used = mem_total = disk = load = ip = os_name = hostname = "ERR"
-    
+        chan.exec_command(script)
+        out = chan.makefile("rb").read()
+    finally: chan.close()
+    facts = {}
+    for line in out.decode(errors="replace").splitlines():
+        key, sep, value = line.partition("=")
+        if sep: facts[key] = value.strip()
+    return facts
+
+# сбор фактов одним exec-каналом; статичные берутся из кеша, пока он свежий
+def probe_info(ssh, server=None, refresh=False):
+    cached = db.facts(server["id"]) if server and server.get("id") and not refresh else None
+    fresh = cached and time.time() - cached[1] < FACTS_TTL
+    facts = run_probe(ssh, INFO_DYNAMIC_PROBE if fresh else INFO_STATIC_PROBE + INFO_DYNAMIC_PROBE, server)
+    if fresh: facts.update(cached[0])
+    elif server and server.get("id"): db.save_facts(server["id"], {k: facts.get(k, "") for k in STATIC_FACTS})
+    return facts
+
+# панель с информацией о сервере
+def info_panel(facts):
+    get = lambda k: facts.get(k) or "N/A"
     data = {
-        "Имя": hostname,
-        "IP": ip,
-        "ОС": os_name,
-        "Аптайм": run("uptime -p"),
-        "ЦПУ": f"{cpu_model} ({cpu_cores} ядер)",
-        "Память": f"{mem_used} / {mem_total}",
-        "Диск": disk,
-        "Нагрузка": load
+        "Имя": get("hostname"),
+        "IP": get("ip"),
+        "ОС": get("os_name"),
+        "Аптайм": get("uptime"),
+        "ЦПУ": f"{get('cpu_model')} ({get('cpu_cores')} ядер)",
+        "Память": f"{get('mem_used')} / {get('mem_total')}",
+        "Диск": get("disk"),
+        "Нагрузка": get("load")
     }
     t = Table.grid(padding=(0, 2))
     t.add_column(style="cyan", justify="right")
     t.add_column(style="green")
     for k, v in data.items(): t.add_row(f"🔹 {k}:", v)
-    console.print(Panel(t, title="[bold yellow]📊 Сервер информация[/bold yellow]", border_style="blue", box=box.ROUNDED))
+    return Panel(t, title="[bold yellow]📊 Сервер информация[/bold yellow]", border_style="blue", box=box.ROUNDED)
+
+# показ информации о сервере
+def show_infovds(ssh, server=None, refresh=False):
+    try: facts = probe_info(ssh, server, refresh)
+    except Exception as e:
+        console.print(f"❌ Ошибка получения данных: {e}", style="red")
+        facts = {k: "ERR" for k in STATIC_FACTS + DYNAMIC_FACTS}
+    console.print(info_panel(facts))
     console.print("→ Введите команду...", style="dim")
 
+# infovds --watch: панель перерисовывается на месте до Ctrl+C
+def watch_infovds(ssh, server=None, interval=INFO_WATCH_INTERVAL):
+    facts = probe_info(ssh, server)
+    try:
+        with Live(info_panel(facts), console=console, auto_refresh=False) as live:
+            while True:
+                time.sleep(interval)
+                facts.update(run_probe(ssh, INFO_DYNAMIC_PROBE, server))
+                live.update(info_panel(facts), refresh=True)
+    except KeyboardInterrupt: pass
+
+# человекочитаемый размер
+def human_size(n):
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if abs(n) < 1024: return f"{n:.1f} {unit}" if unit != "Б" else f"{int(n)} {unit}"
+        n /= 1024
+    return f"{n:.1f} ТБ"
+
+# путь внутри дерева: пустой относительный путь означает сам корень
+def remote_join(root, rel):
+    return f"{root.rstrip('/')}/{rel}" if rel else root
+
+def local_join(root, rel):
+    return os.path.join(root, *rel.split("/")) if rel else root
+
+# манифест локального дерева: каталоги (родитель раньше детей) и {путь: (размер, mtime)}
+def local_manifest(root):
+    if not os.path.isdir(root):
+        st = os.stat(root)
+        return [], {"": (st.st_size, int(st.st_mtime))}
+    dirs, files = [], {}
+    for path, subdirs, names in os.walk(root, followlinks=True):
+        subdirs.sort()
+        rel = os.path.relpath(path, root).replace(os.sep, "/")
+        rel = "" if rel == "." else rel
+        dirs.append(rel)
+        for name in sorted(names):
+            try:
+                st = os.stat(os.path.join(path, name))
+                entry = (st.st_size, int(st.st_mtime))
+            except OSError: entry = (0, 0)
+            files[f"{rel}/{name}" if rel else name] = entry
+    return dirs, files
+
+# записи удалённого дерева (путь, "d" | "f", размер, mtime) по мере получения, родитель раньше детей;
+# по возможности одним потоком find -printf, иначе параллельными listdir_attr.
+# Нечитаемые каталоги и циклы ссылок не прерывают обход, а попадают в errors как (путь, ошибка)
+def walk_remote(sftp, root, workers=WALK_WORKERS, errors=None):
+    errors = [] if errors is None else errors
+    transport = sftp.get_channel().get_transport()
+    stream = find_stream(transport, root, errors)
+    return stream if stream is not None else sftp_walk(sftp, root, workers, errors)
+
+# строки stderr find как ошибки по записям: путь берётся из кавычек сообщения
+def find_errors(root, stderr):
+    errors = []
+    for line in stderr.decode(errors="replace").splitlines():
+        line = line.strip()
+        if line.startswith("find: "): line = line[6:]
+        if not line: continue
+        quoted = re.search(r"[‘'`]([^’']+)[’']", line)
+        errors.append((quoted.group(1) if quoted else root, line))
+    return errors
+
+# одна exec-команда на всё дерево; None, если на сервере нет GNU find
+def find_stream(transport, root, errors):
+    chan = transport.open_session(timeout=CHANNEL_OPEN_TIMEOUT)
+    chan.exec_command(f"find -L {shlex.quote(root)} -mindepth 1 -printf '%y\\t%s\\t%T@\\t%P\\0'")
+    first = chan.recv(65536)
+    if not first:
+        if chan.recv_exit_status() != 0:
+            chan.close()
+            return None
+    def entries(buffer):
+        stderr = b""
+        try:
+            while True:
+                *records, buffer = buffer.split(b"\0")
+                for record in records:
+                    kind, size, mtime, rel = record.decode(errors="replace").split("\t", 3)
+                    if kind in ("d", "f"): yield rel, kind, int(size) if kind == "f" else 0, int(float(mtime))
+                # stderr вычитывается по ходу, чтобы не занимать окно канала
+                while chan.recv_stderr_ready(): stderr += chan.recv_stderr(65536)
+                data = chan.recv(65536)
+                if not data: break
+                buffer += data
+            status = chan.recv_exit_status()
+            while True:
+                data = chan.recv_stderr(65536)
+                if not data: break
+                stderr += data
+            found = find_errors(root, stderr)
+            if status != 0 and not found: found = [(root, f"find завершился с кодом {status}")]
+            errors.extend(found)
+        finally: chan.close()
+    return entries(first)
+
+# обход по SFTP: каталоги читаются параллельно в нескольких каналах, тип берётся из listdir_attr.
+# Для каталогов помнится настоящий путь (normalize только у ссылок): ссылка на предка — цикл, в неё не заходим
+def sftp_walk(sftp, root, workers=WALK_WORKERS, errors=None):
+    errors = [] if errors is None else errors
+    transport = sftp.get_channel().get_transport()
+    local = threading.local()
+    clients = []
+    real = {"": sftp.normalize(root)}
+    def listing(rel):
+        if not hasattr(local, "sftp"):
+            local.sftp = transport.open_sftp_client()
+            clients.append(local.sftp)
+        try: return rel, local.sftp.listdir_attr(remote_join(root, rel))
+        except IOError as e:
+            if not rel: raise
+            errors.append((remote_join(root, rel), str(e)))
+            return rel, []
+    ex = ThreadPoolExecutor(max_workers=max(1, workers))
+    pending = {ex.submit(listing, "")}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rel, attrs = future.result()
+                for a in sorted(attrs, key=lambda a: a.filename):
+                    child = f"{rel}/{a.filename}" if rel else a.filename
+                    path = remote_join(root, child)
+                    link = stat.S_ISLNK(a.st_mode)
+                    if link:
+                        try: a = sftp.stat(path)
+                        except IOError: continue
+                    if stat.S_ISDIR(a.st_mode):
+                        if link:
+                            try: target = sftp.normalize(path)
+                            except IOError: continue
+                            if target == real[rel] or real[rel].startswith(target.rstrip("/") + "/"):
+                                errors.append((path, "цикл символических ссылок"))
+                                continue
+                            real[child] = target
+                        else: real[child] = remote_join(real[rel], a.filename)
+                        pending.add(ex.submit(listing, child))
+                        yield child, "d", 0, int(a.st_mtime or 0)
+                    elif stat.S_ISREG(a.st_mode): yield child, "f", a.st_size or 0, int(a.st_mtime or 0)
+    finally:
+        for future in pending: future.cancel()
+        ex.shutdown(wait=True)
+        for client in clients: client.close()
+
+# манифест удалённого дерева из потока walk_remote
+def remote_manifest(sftp, root, errors=None):
+    attrs = sftp.stat(root)
+    if not stat.S_ISDIR(attrs.st_mode): return [], {"": (attrs.st_size or 0, int(attrs.st_mtime or 0))}
+    dirs, files = [""], {}
+    for rel, kind, size, mtime in walk_remote(sftp, root, errors=errors):
+        if kind == "d": dirs.append(rel)
+        else: files[rel] = (size, mtime)
+    return dirs, files
+
+# план загрузки: каталоги до файлов, файлы как (источник, назначение, размер, mtime)
+def plan_upload(local, remote, manifest=None, only=None):
+    dirs, files = manifest or local_manifest(local)
+    remote = remote.rstrip("/") or "/"
+    return ([remote_join(remote, d) for d in dirs],
+            [(local_join(local, rel), remote_join(remote, rel), size, mtime) for rel, (size, mtime) in files.items() if only is None or rel in only])
+
+# план скачивания по манифесту удалённого дерева
+def plan_download(sftp, remote, local, manifest=None, only=None):
+    dirs, files = manifest or remote_manifest(sftp, remote)
+    return ([local_join(local, d) for d in dirs],
+            [(remote_join(remote, rel), local_join(local, rel), size, mtime) for rel, (size, mtime) in files.items() if only is None or rel in only])
+
+# перенос mtime источника на назначение, чтобы sync видел файл неизменённым
+def set_mtime(sftp, path, mtime, remote):
+    if remote: sftp.utime(path, (mtime, mtime))
+    else: os.utime(path, (mtime, mtime))
+
+# sha256 локального файла
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""): h.update(block)
+    return h.hexdigest()
+
+# крупный файл: диапазоны пишутся по смещениям в несколько каналов,
+# готовые диапазоны отмечаются в журнале рядом с .part на стороне назначения
+class RangedTransfer:
+    def __init__(self, engine, src, dst, size, mtime, upload):
+        self.engine = engine
+        self.src = src
+        self.dst = dst
+        self.size = size
+        self.mtime = mtime
+        self.upload = upload
+        self.part = dst + PART_SUFFIX
+        self.journal = self.part + ".json"
+        self.lock = threading.Lock()
+        self.ranges = [(offset, min(RANGE_SIZE, size - offset)) for offset in range(0, size, RANGE_SIZE)]
+        self.source = [size, int(mtime)]
+        self.done = self._load_journal()
+        self.pending = len(self.ranges) - len(self.done)
+
+    # файл на стороне назначения: удалённый при загрузке, локальный при скачивании
+    def _open(self, path, mode, sftp=None):
+        if self.upload: return (sftp or self.engine.sftp).open(path, mode)
+        return open(path, mode + "b")
+
+    def _load_journal(self):
+        try:
+            with self._open(self.journal, "r") as f: data = json.loads(f.read())
+            if data.get("source") == self.source and data.get("range") == RANGE_SIZE:
+                done = set(data["done"])
+                console.print(f"↻ Продолжение {self.dst}: готово {len(done)}/{len(self.ranges)} диапазонов", style="dim")
+                return done
+        except (IOError, OSError, ValueError, KeyError): pass
+        if not self.upload and os.path.dirname(self.part): os.makedirs(os.path.dirname(self.part), exist_ok=True)
+        with self._open(self.part, "w"): pass
+        return set()
+
+    def _save_journal(self, sftp):
+        data = json.dumps({"source": self.source, "range": RANGE_SIZE, "done": sorted(self.done)})
+        with self._open(self.journal, "w", sftp) as f: f.write(data.encode())
+
+    # задания для пула: по одному на недокачанный диапазон
+    def jobs(self):
+        if not self.pending: return [(self.src, 0, self._finish)]
+        return [(self.src, length, self._job(i, offset, length)) for i, (offset, length) in enumerate(self.ranges) if i not in self.done]
+
+    def _job(self, index, offset, length):
+        def run(sftp, callback):
+            if self.upload: self._put_range(sftp, offset, length, callback)
+            else: self._get_range(sftp, offset, length, callback)
+            with self.lock:
+                self.done.add(index)
+                self._save_journal(sftp)
+                self.pending -= 1
+                last = not self.pending
+            return self._finish(sftp) if last else False
+        return run
+
+    def _put_range(self, sftp, offset, length, callback):
+        with open(self.src, "rb") as lf, sftp.open(self.part, "r+") as rf:
+            rf.set_pipelined(True)
+            lf.seek(offset)
+            rf.seek(offset)
+            sent = 0
+            while sent < length:
+                data = lf.read(min(CHUNK_SIZE, length - sent))
+                if not data: raise IOError("исходный файл изменился во время передачи")
+                rf.write(data)
+                sent += len(data)
+                callback(sent, length)
+
+    def _get_range(self, sftp, offset, length, callback):
+        chunks = [(o, min(CHUNK_SIZE * 8, offset + length - o)) for o in range(offset, offset + length, CHUNK_SIZE * 8)]
+        got = 0
+        with sftp.open(self.src, "r") as rf, open(self.part, "r+b") as lf:
+            lf.seek(offset)
+            for data in rf.readv(chunks):
+                lf.write(data)
+                got += len(data)
+                callback(got, length)
+        if got != length: raise IOError(f"получено {got} из {length} байт диапазона")
+
+    # проверка размера и sha256, затем .part переименовывается в итоговое имя
+    def _finish(self, sftp, callback=None):
+        size = sftp.stat(self.part).st_size if self.upload else os.path.getsize(self.part)
+        if size != self.size:
+            self._reset(sftp)
+            raise IOError(f"размер {size} вместо {self.size}, передача начнётся заново")
+        local_path, remote_path = (self.src, self.part) if self.upload else (self.part, self.src)
+        chan = self.engine.transport.open_session()
+        chan.exec_command(f"sha256sum {shlex.quote(remote_path)}")
+        local_sum = file_sha256(local_path)
+        remote_out = chan.makefile("rb").read().decode(errors="replace")
+        if chan.recv_exit_status() == 0:
+            if remote_out.split()[0] != local_sum:
+                self._reset(sftp)
+                raise IOError("контрольная сумма не совпала, передача начнётся заново")
+        else: console.print(f"⚠️ sha256sum недоступен на сервере, {self.dst} проверен только по размеру", style="yellow")
+        if self.upload:
+            try: sftp.posix_rename(self.part, self.dst)
+            except IOError:
+                try: sftp.remove(self.dst)
+                except IOError: pass
+                sftp.rename(self.part, self.dst)
+            sftp.remove(self.journal)
+        else:
+            os.replace(self.part, self.dst)
+            os.remove(self.journal)
+        set_mtime(sftp, self.dst, self.mtime, self.upload)
+        return True
+
+    def _reset(self, sftp):
+        for path in (self.part, self.journal):
+            try: sftp.remove(path) if self.upload else os.remove(path)
+            except (IOError, OSError): pass
+
+# владелец в архиве как у файлов, созданных по SFTP
+def _tar_owner(info):
+    info.uid = info.gid = 0
+    info.uname = info.gname = "root"
+    return info
+
+# запрет путей вне каталога назначения при распаковке
+def _tar_member_safe(member):
+    name = member.name.replace("\\", "/")
+    if name.startswith("/") or ".." in name.split("/"): return False
+    if member.issym() or member.islnk():
+        link = member.linkname.replace("\\", "/")
+        if link.startswith("/") or ".." in link.split("/"): return False
+    return True
+
+# обёртка файла, сообщающая о прочитанных байтах
+class _CountingReader:
+    def __init__(self, f, on_read):
+        self.f = f
+        self.on_read = on_read
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.on_read(len(data))
+        return data
+
+# многоканальная передача: пул воркеров, у каждого свой SFTP-канал на общем транспорте
+class TransferEngine:
+    def __init__(self, sftp, workers=TRANSFER_WORKERS):
+        self.sftp = sftp
+        self.transport = sftp.get_channel().get_transport()
+        self.workers = max(1, workers)
+        self.errors = []
+        self.done_files = 0
+        self.done_bytes = 0
+        self.resumable = False
+        self.cancelled = False
+        self.started = time.time()
+        self._local = threading.local()
+        self._channels = []
+        self._lock = threading.Lock()
+
+    # SFTP-канал текущего воркера, открывается один раз на поток
+    def channel(self):
+        sftp = getattr(self._local, "sftp", None)
+        if sftp is None:
+            sftp = paramiko.SFTPClient.from_transport(self.transport)
+            with self._lock: self._channels.append(sftp)
+            self._local.sftp = sftp
+        return sftp
+
+    def close(self):
+        for sftp in self._channels:
+            try: sftp.close()
+            except Exception: pass
+        self._channels = []
+
+    def fail(self, path, error):
+        with self._lock: self.errors.append((path, str(error)))
+
+    # загрузка: каталоги по порядку до файлов, затем файлы параллельно
+    def upload(self, dirs, files):
+        for d in dirs:
+            try: self.sftp.mkdir(d)
+            except IOError:
+                try:
+                    if not stat.S_ISDIR(self.sftp.stat(d).st_mode): self.fail(d, "существует и не является каталогом")
+                except IOError as e: self.fail(d, e)
+        self._run(self._jobs(files, True), len(files), "📤 Загрузка")
+
+    # скачивание: локальные каталоги создаются до файлов
+    def download(self, dirs, files):
+        for d in dirs:
+            try: os.makedirs(d, exist_ok=True)
+            except OSError as e: self.fail(d, e)
+        self._run(self._jobs(files, False), len(files), "📥 Скачивание")
+
+    # задания пула: мелкие файлы целиком, крупные — диапазонами
+    def _jobs(self, files, upload):
+        jobs = []
+        for src, dst, size, mtime in files:
+            if size < RANGE_THRESHOLD:
+                jobs.append((src, size, self._whole(src, dst, mtime, upload)))
+                continue
+            try: jobs.extend(RangedTransfer(self, src, dst, size, mtime, upload).jobs())
+            except Exception as e: self.fail(src, e)
+            self.resumable = True
+        return jobs
+
+    def _whole(self, src, dst, mtime, upload):
+        def run(sftp, callback):
+            if upload: sftp.put(src, dst, callback=callback)
+            else:
+                parent = os.path.dirname(dst)
+                if parent: os.makedirs(parent, exist_ok=True)
+                sftp.get(src, dst, callback=callback)
+            set_mtime(sftp, dst, mtime, upload)
+            return True
+        return run
+
+    def _progress(self):
+        columns = (TextColumn("{task.description}"), BarColumn(), DownloadColumn(), TransferSpeedColumn(), TimeRemainingColumn())
+        return Progress(*columns, console=console, transient=True)
+
+    def _run(self, jobs, count, label):
+        if not jobs: return
+        total = [sum(size for _, size, _ in jobs)]
+        failed = set()
+        with self._progress() as progress:
+            task = progress.add_task(f"{label} 0/{count}", total=total[0])
+
+            def work(job):
+                path, size, fn = job
+                sent = [0]
+                def callback(done, _):
+                    if self.cancelled: raise IOError("прервано пользователем")
+                    progress.advance(task, done - sent[0])
+                    sent[0] = done
+                try:
+                    if self.cancelled: raise IOError("прервано пользователем")
+                    finished = fn(self.channel(), callback)
+                    progress.advance(task, size - sent[0])
+                    with self._lock:
+                        self.done_bytes += size
+                        if finished: self.done_files += 1
+                except Exception as e:
+                    with self._lock:
+                        if path not in failed:
+                            failed.add(path)
+                            self.errors.append((path, str(e)))
+                        total[0] -= size - sent[0]
+                        progress.update(task, total=total[0])
+                progress.update(task, description=f"{label} {self.done_files + len(failed)}/{count}")
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                try:
+                    for _ in pool.map(work, jobs): pass
+                except KeyboardInterrupt:
+                    self.cancelled = True
+
+    # загрузка одним tar-потоком в удалённый tar -x, без архива на диске
+    def tar_upload(self, local, remote, compress=False, manifest=None):
+        dirs, files = manifest or local_manifest(local)
+        chan = self.transport.open_session()
+        chan.exec_command(f"mkdir -p {shlex.quote(remote)} && tar -x{'z' if compress else ''}f - -C {shlex.quote(remote)}")
+        stream = chan.makefile("wb")
+        stream_error = None
+        try:
+            with self._progress() as progress:
+                task = progress.add_task("📦 tar →", total=sum(size for size, _ in files.values()))
+                with tarfile.open(fileobj=stream, mode="w|gz" if compress else "w|") as tar:
+                    for rel in dirs:
+                        if rel: tar.add(local_join(local, rel), arcname=rel, recursive=False, filter=_tar_owner)
+                    for rel in files:
+                        path = local_join(local, rel)
+                        try: f = open(path, "rb")
+                        except OSError as e:
+                            self.fail(path, e)
+                            continue
+                        with f:
+                            info = _tar_owner(tar.gettarinfo(arcname=rel, fileobj=f))
+                            tar.addfile(info, _CountingReader(f, lambda n: progress.advance(task, n)))
+                        self.done_files += 1
+                        self.done_bytes += info.size
+            stream.flush()
+            chan.shutdown_write()
+        except (OSError, EOFError, paramiko.SSHException, tarfile.TarError) as e: stream_error = e
+        self._tar_status(chan, remote, stream_error)
+
+    # скачивание одним потоком удалённого tar -c с распаковкой на лету
+    def tar_download(self, remote, local, compress=False, total=None):
+        chan = self.transport.open_session()
+        chan.exec_command(f"tar -c{'z' if compress else ''}f - -C {shlex.quote(remote)} .")
+        os.makedirs(local, exist_ok=True)
+        stream_error = None
+        try:
+            with self._progress() as progress:
+                task = progress.add_task("📦 tar ←", total=total)
+                with tarfile.open(fileobj=chan.makefile("rb"), mode="r|gz" if compress else "r|") as tar:
+                    for member in tar:
+                        if not _tar_member_safe(member):
+                            self.fail(member.name, "небезопасный путь в архиве, пропущен")
+                            continue
+                        tar.extract(member, local, **TAR_EXTRACT_ARGS)
+                        if member.isfile():
+                            self.done_files += 1
+                            self.done_bytes += member.size
+                            progress.advance(task, member.size)
+        except (OSError, EOFError, paramiko.SSHException, tarfile.TarError) as e: stream_error = e
+        self._tar_status(chan, remote, stream_error)
+
+    # ошибка удалённого tar важнее ошибки потока, которую она вызвала
+    def _tar_status(self, chan, path, stream_error=None):
+        error = chan.makefile_stderr("rb").read().decode(errors="replace").strip()
+        if chan.recv_exit_status() != 0: self.fail(path, error or "удалённый tar завершился с ошибкой")
+        elif stream_error: self.fail(path, stream_error)
+
+    # итог: объём, время, средняя скорость и ошибки по файлам
+    def report(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        console.print(f"📦 Файлов: {self.done_files}, {human_size(self.done_bytes)} за {elapsed:.1f} с ({human_size(self.done_bytes / elapsed)}/с)", style="cyan")
+        if self.errors:
+            t = Table(title=f"❌ Ошибки ({len(self.errors)})", box=box.SIMPLE)
+            t.add_column("Путь")
+            t.add_column("Ошибка", style="red")
+            for path, error in self.errors: t.add_row(path, error)
+            console.print(t)
+            if self.resumable: console.print("↻ Повторите команду — крупные файлы продолжатся с места остановки", style="dim")
+
 # загрузка файла/директории
-def upload_item(sftp, local, remote):
-    if os.path.isfile(local):
-        console.print(f"📤 Загрузка: {local} → {remote}", style="cyan")
-        try: sftp.put(local, remote)
-        except Exception as e: console.print(f"❌ Ошибка загрузки: {e}", style="red")
-    elif os.path.isdir(local):
-        try: sftp.mkdir(remote)
-        except: pass
-        for item in os.listdir(local):
-            l = os.path.join(local, item)
-            r = f"{remote.rstrip('/')}/{item}"
-            upload_item(sftp, l, r)
+def upload_item(sftp, local, remote, workers=TRANSFER_WORKERS, manifest=None):
+    engine = TransferEngine(sftp, workers)
+    try: engine.upload(*plan_upload(local, remote, manifest))
+    finally: engine.close()
+    return engine
 
 # скачивание файла/директории
-def download_item(sftp, remote, local):
-    try: attrs = sftp.stat(remote)
-    except Exception as e: 
-        console.print(f"❌ Удалённый путь не найден: {remote} ({e})", style="red")
-        return
-    
-    if not attrs.st_mode & 0o040000:
-        os.makedirs(os.path.dirname(local), exist_ok=True)
-        console.print(f"📥 Скачивание: {remote} → {local}", style="cyan")
-        try: sftp.get(remote, local)
-        except Exception as e: console.print(f"❌ Ошибка скачивания: {e}", style="red")
+def download_item(sftp, remote, local, workers=TRANSFER_WORKERS, manifest=None):
+    engine = TransferEngine(sftp, workers)
+    try: plan = plan_download(sftp, remote, local, manifest)
+    except IOError as e:
+        engine.fail(remote, f"удалённый путь не найден ({e})")
+        return engine
+    try: engine.download(*plan)
+    finally: engine.close()
+    return engine
+
+# sha256 удалённых файлов одним вызовом: пути уходят в stdin xargs из отдельного потока,
+# чтобы вывод читался одновременно с записью и окно канала не заполнялось с обеих сторон
+def remote_sha256(transport, paths):
+    if not paths: return {}
+    chan = transport.open_session()
+    chan.exec_command("xargs -0 sha256sum -- 2>/dev/null")
+    def feed():
+        try:
+            chan.sendall("\0".join(paths).encode())
+            chan.shutdown_write()
+        except (OSError, EOFError, paramiko.SSHException): pass
+    writer = in_background(feed)
+    out = chan.makefile("rb").read().decode(errors="replace")
+    writer.result()
+    chan.recv_exit_status()
+    return {line[66:]: line[:64] for line in out.splitlines() if len(line) > 66 and not line.startswith("\\")}
+
+# синхронизация: передаются только новые и изменённые файлы, лишние удаляются по --delete
+def sync_item(sftp, src, dst, upload, opts):
+    engine = TransferEngine(sftp, opts.get("workers", TRANSFER_WORKERS))
+    walk_errors = []
+    try: src_dirs, src_files = local_manifest(src) if upload else remote_manifest(sftp, src, walk_errors)
+    except (IOError, OSError) as e:
+        engine.fail(src, f"источник не найден ({e})")
+        return engine
+    try: dst_dirs, dst_files = remote_manifest(sftp, dst, walk_errors) if upload else local_manifest(dst)
+    except (IOError, OSError): dst_dirs, dst_files = None, {}
+    for path, error in walk_errors: engine.fail(path, error)
+    if dst_dirs is not None and bool(src_dirs) != bool(dst_dirs):
+        engine.fail(dst, "источник и назначение разного типа (файл/каталог)")
+        return engine
+    dst_dirs = dst_dirs or []
+
+    if opts.get("hash"):
+        local_root, remote_root = (src, dst) if upload else (dst, src)
+        same_size = [rel for rel, (size, _) in src_files.items() if rel in dst_files and dst_files[rel][0] == size]
+        remote = remote_sha256(engine.transport, [remote_join(remote_root, rel) for rel in same_size])
+        unchanged = {rel for rel in same_size if remote.get(remote_join(remote_root, rel)) == file_sha256(local_join(local_root, rel))}
     else:
-        os.makedirs(local, exist_ok=True)
-        for item in sftp.listdir(remote):
-            r = f"{remote.rstrip('/')}/{item}"
-            l = os.path.join(local, item)
-            try:
-                sftp.stat(r + "/")
-                download_item(sftp, r, l)
-            except:
-                os.makedirs(os.path.dirname(l), exist_ok=True)
-                console.print(f"📥 Скачивание: {r} → {l}", style="cyan")
-                try: sftp.get(r, l)
-                except Exception as e: console.print(f"❌ Ошибка: {e}", style="red")
+        unchanged = {rel for rel, entry in src_files.items() if dst_files.get(rel) == entry}
+    new = [rel for rel in src_files if rel not in dst_files]
+    changed = [rel for rel in src_files if rel in dst_files and rel not in unchanged]
+    send = set(new) | set(changed)
+    known_dirs = set(dst_dirs)
+    missing_dirs = [d for d in src_dirs if d not in known_dirs]
+    extra_files, extra_dirs = [], []
+    if opts.get("delete"):
+        source_dirs = set(src_dirs)
+        extra_files = [rel for rel in dst_files if rel not in src_files]
+        extra_dirs = sorted((d for d in dst_dirs if d and d not in source_dirs), key=lambda d: d.count("/"), reverse=True)
+
+    total = sum(size for size, _ in src_files.values())
+    to_send = sum(src_files[rel][0] for rel in send)
+    summary = f"🔄 Новых: {len(new)}, изменённых: {len(changed)}, без изменений: {len(unchanged)}"
+    if opts.get("delete"): summary += f", к удалению: {len(extra_files)}"
+    console.print(summary, style="cyan")
+    console.print(f"📦 К передаче {human_size(to_send)} из {human_size(total)} (экономия {human_size(total - to_send)})", style="cyan")
+
+    if opts.get("dry_run"):
+        plan = [("+", rel, src_files[rel][0]) for rel in new] + [("~", rel, src_files[rel][0]) for rel in changed] + [("-", rel, dst_files[rel][0]) for rel in extra_files]
+        if plan:
+            t = Table(box=box.SIMPLE)
+            t.add_column("")
+            t.add_column("Путь")
+            t.add_column("Размер", justify="right")
+            for action, rel, size in plan[:SYNC_PREVIEW]: t.add_row(action, rel or os.path.basename(src), human_size(size))
+            console.print(t)
+            if len(plan) > SYNC_PREVIEW: console.print(f"… и ещё {len(plan) - SYNC_PREVIEW}", style="dim")
+        return None
+
+    manifest = (missing_dirs, src_files)
+    try:
+        if upload: engine.upload(*plan_upload(src, dst, manifest, send))
+        else: engine.download(*plan_download(sftp, src, dst, manifest, send))
+    finally: engine.close()
+    for rel in extra_files:
+        path = remote_join(dst, rel) if upload else local_join(dst, rel)
+        try: sftp.remove(path) if upload else os.remove(path)
+        except (IOError, OSError) as e: engine.fail(path, e)
+    for rel in extra_dirs:
+        path = remote_join(dst, rel) if upload else local_join(dst, rel)
+        try: sftp.rmdir(path) if upload else os.rmdir(path)
+        except (IOError, OSError) as e: engine.fail(path, e)
+    return engine
+
+# на сервере есть команда (tar, find и т.п.)
+def remote_has(transport, command):
+    chan = transport.open_session(timeout=CHANNEL_OPEN_TIMEOUT)
+    try:
+        chan.exec_command(f"command -v {shlex.quote(command)} >/dev/null 2>&1")
+        return chan.recv_exit_status() == 0
+    finally: chan.close()
+
+# tar-поток выгоднее SFTP, когда файлов много и они мелкие
+def prefer_tar(opts, count, total):
+    if opts.get("tar") is not None: return opts["tar"]
+    return count >= TAR_MIN_FILES and total / count < TAR_AVG_SIZE
+
+# разбор аргументов file: [sync] [-j N] [--tar|--no-tar] [-z] [--delete] [--dry-run] [--hash] <источник> <назначение>
+def parse_file_args(args):
+    opts = {"workers": TRANSFER_WORKERS, "sync": False, "delete": False, "dry_run": False, "hash": False, "tar": None, "compress": False}
+    sync_flags = {"--delete": "delete", "--dry-run": "dry_run", "--hash": "hash"}
+    rest = args.strip()
+    if rest.startswith("sync "):
+        opts["sync"] = True
+        rest = rest[5:].lstrip()
+    while rest.startswith("-"):
+        flag, _, rest = rest.partition(" ")
+        rest = rest.lstrip()
+        if flag == "-j":
+            value, _, rest = rest.partition(" ")
+            rest = rest.lstrip()
+            opts["workers"] = int(value)
+        elif flag in ("--tar", "--no-tar"): opts["tar"] = flag == "--tar"
+        elif flag == "-z": opts["compress"] = True
+        elif flag in sync_flags and opts["sync"]: opts[sync_flags[flag]] = True
+        else: raise ValueError(f"неизвестный флаг {flag}")
+    parts = rest.split(maxsplit=1)
+    if len(parts) < 2: raise ValueError("Использование: file [sync] [-j N] [--tar|--no-tar] [-z] [--delete] [--dry-run] [--hash] <источник> <назначение>")
+    return opts, parts[0], parts[1]
+
+# SFTP-сессия с таймаутом открытия канала (ssh.open_sftp ждёт до часа на мёртвом соединении)
+def open_sftp(ssh):
+    chan = ssh.get_transport().open_session(timeout=CHANNEL_OPEN_TIMEOUT)
+    chan.invoke_subsystem("sftp")
+    return paramiko.SFTPClient(chan)
+
+# потоковый рекурсивный список удалённого каталога; Ctrl+C останавливает вывод
+def list_remote_tree(ssh, path):
+    try: sftp = open_sftp(ssh)
+    except (paramiko.SSHException, EOFError, OSError) as e:
+        console.print(f"❌ {path}: {e}", style="red")
+        return
+    count, dirs, total = 0, 0, 0
+    errors = []
+    try:
+        for rel, kind, size, mtime in walk_remote(sftp, path, errors=errors):
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime))
+            if kind == "d": dirs += 1
+            else: count, total = count + 1, total + size
+            console.print(f"{'📁' if kind == 'd' else '  '} {human_size(size) if kind == 'f' else '':>10}  {when}  {rel}{'/' if kind == 'd' else ''}", markup=False, highlight=False)
+    except KeyboardInterrupt: console.print("⏹ Прервано", style="yellow")
+    except (IOError, OSError) as e: console.print(f"❌ {path}: {e}", style="red")
+    finally: sftp.close()
+    for where, error in errors: console.print(f"❌ {where}: {error}", style="red", markup=False, highlight=False)
+    console.print(f"Каталогов: {dirs}, файлов: {count}, объём: {human_size(total)}", style="bold")
 
 # обработка команды file
-def handle_file_cmd(ssh, src, dst):
+def handle_file_cmd(ssh, src, dst, opts=None):
+    opts = opts or {}
+    workers = opts.get("workers", TRANSFER_WORKERS)
     try:
-        sftp = ssh.open_sftp()
-        if os.path.exists(src):
-            upload_item(sftp, src, dst)
-            console.print("✅ Загрузка завершена", style="green")
+        sftp = open_sftp(ssh)
+        upload = os.path.exists(src)
+        if opts.get("sync"):
+            engine = sync_item(sftp, src, dst, upload, opts)
+            done = "✅ Синхронизация завершена"
+        elif upload:
+            manifest = local_manifest(src)
+            files = manifest[1]
+            if manifest[0] and prefer_tar(opts, len(files), sum(size for size, _ in files.values())) and remote_has(sftp.get_channel().get_transport(), "tar"):
+                engine = TransferEngine(sftp, workers)
+                engine.tar_upload(src, dst, opts.get("compress"), manifest)
+            else: engine = upload_item(sftp, src, dst, workers, manifest)
+            done = "✅ Загрузка завершена"
         else:
-            download_item(sftp, src, dst)
-            console.print("✅ Скачивание завершено", style="green")
+            # один обход дерева и для выбора tar, и для плана SFTP
+            walk_errors = []
+            try: manifest = remote_manifest(sftp, src, walk_errors)
+            except IOError as e:
+                console.print(f"❌ Удалённый путь не найден: {src} ({e})", style="red")
+                sftp.close()
+                return
+            files = manifest[1]
+            total = sum(size for size, _ in files.values())
+            if manifest[0] and prefer_tar(opts, len(files), total) and remote_has(sftp.get_channel().get_transport(), "tar"):
+                engine = TransferEngine(sftp, workers)
+                engine.tar_download(src, dst, opts.get("compress"), total or None)
+            else: engine = download_item(sftp, src, dst, workers, manifest)
+            for path, error in walk_errors: engine.fail(path, error)
+            done = "✅ Скачивание завершено"
         sftp.close()
+        if engine is None: return
+        engine.report()
+        if engine.errors: console.print(f"⚠️ Завершено с ошибками: {len(engine.errors)}", style="yellow")
+        else: console.print(done, style="green")
     except Exception as e:
         console.print(f"❌ Ошибка SFTP: {e}", style="red")
 
+# поток вывода до маркера конца команды: текст отдаётся по мере поступления,
+# придерживается только хвост, в котором может начинаться маркер
+class _MarkedStream:
+    def __init__(self, marker, emit, with_status=False):
+        self.marker = marker
+        self.emit = emit
+        self.with_status = with_status
+        self.buf = b""
+        self.done = False
+        self.status = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def feed(self, data):
+        self.buf += data
+        i = self.buf.find(self.marker)
+        if i < 0:
+            keep = next((n for n in range(min(len(self.marker) - 1, len(self.buf)), 0, -1) if self.marker.startswith(self.buf[-n:])), 0)
+            self._emit(self.buf[:len(self.buf) - keep])
+            self.buf = self.buf[len(self.buf) - keep:]
+            return
+        if self.with_status:
+            j = self.buf.find(b"\n", i + len(self.marker))
+            if j < 0:
+                self._emit(self.buf[:i])
+                self.buf = self.buf[i:]
+                return
+            self.status = self.buf[i + len(self.marker):j]
+        self._emit(self.buf[:i], final=True)
+        self.buf = b""
+        self.done = True
+
+    def _emit(self, data, final=False):
+        text = self.decoder.decode(data, final)
+        if text: self.emit(text)
+
+# вывод команды пачками: терминал обновляется по объёму, по времени или когда данные иссякли
+class StreamPrinter:
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+        self.flushed = time.time()
+        self.last_char = "\n"
+
+    def out(self, text): self._write(text, None)
+
+    def err(self, text): self._write(text, "red")
+
+    def _write(self, text, style):
+        self.parts.append((text, style))
+        self.size += len(text)
+        self.last_char = text[-1]
+        if self.size >= OUTPUT_FLUSH_BYTES or time.time() - self.flushed >= OUTPUT_FLUSH_INTERVAL: self.flush()
+
+    def flush(self):
+        if self.parts:
+            text, style = "", None
+            for part, part_style in self.parts:
+                if part_style != style and text:
+                    console.out(text, style=style, end="", highlight=False)
+                    text = ""
+                text += part
+                style = part_style
+            console.out(text, style=style, end="", highlight=False)
+            console.file.flush()
+        self.parts = []
+        self.size = 0
+        self.flushed = time.time()
+
+    def finish(self):
+        self.flush()
+        if self.last_char != "\n": console.out("")
+
+# долгоживущая оболочка сессии: вывод каждой команды обрамляется маркерами,
+# так что stdout, stderr, код возврата и новый cwd приходят за один проход
+class RemoteShell:
+    def __init__(self, ssh, cwd=None, oldpwd=None):
+        self.ssh = ssh
+        self.token = f"__SSHSCRE_{uuid.uuid4().hex}__".encode()
+        self.chan = None
+        self.cwd = None
+        self.pid = None
+        self.hostname = None
+        self.home = None
+        self.cd_error = None
+        self.start(cwd, oldpwd)
+
+    # канал открывается один раз; заново — только если оболочка завершилась.
+    # Команды выполняются в функции, из которой ловушка USR1 выходит при отмене.
+    # pid, имя хоста, домашний каталог и переход в cwd — одним запросом; значения идут
+    # после строки с токеном, так что вывод .profile и подобных перед ними отбрасывается
+    def start(self, cwd=None, oldpwd=None):
+        self.chan = self.ssh.get_transport().open_session(timeout=CHANNEL_OPEN_TIMEOUT)
+        self.chan.invoke_shell()
+        self.chan.sendall(b"__sshscre_run() { command eval \"$__sshscre_cmd\"; }\ntrap 'return 130' USR1\n")
+        token = self.token.decode()
+        probe = f"printf '%s\\n' {token} \"$$\" \"$(hostname)\" \"$HOME\""
+        if oldpwd: probe += f"; OLDPWD={shlex.quote(oldpwd)}"
+        if cwd: probe += f"; cd {shlex.quote(cwd)}"
+        out, err, rc, _ = self.run(probe)
+        lines = out.splitlines()
+        values = lines[len(lines) - lines[::-1].index(token):] if token in lines else []
+        self.pid, self.hostname, self.home = (values + ["", "", ""])[:3]
+        self.cd_error = err.strip() if cwd and rc else None
+
+    # на оборванном соединении закрытие канала падает — канал уже не нужен
+    def close(self):
+        if self.chan:
+            try: self.chan.close()
+            except (EOFError, OSError, paramiko.SSHException): pass
+
+    # Ctrl+C: через отдельный exec-канал оболочке уходит USR1, а её дочерним процессам TERM;
+    # оболочка прерывает остаток команды и остаётся жива
+    def cancel(self):
+        if not self.pid.isdigit(): return
+        chan = self.ssh.get_transport().open_session(timeout=CHANNEL_OPEN_TIMEOUT)
+        try:
+            chan.exec_command(f"kill -USR1 {self.pid}; pkill -TERM -P {self.pid} 2>/dev/null || kill -TERM $(ps -o pid= --ppid {self.pid}) 2>/dev/null")
+            chan.recv_exit_status()
+        finally: chan.close()
+
+    # команда выполняется через command eval: синтаксическая ошибка не завершает даже POSIX sh;
+    # без обработчиков вывод собирается и возвращается целиком
+    def run(self, cmd, on_out=None, on_err=None, on_idle=None):
+        token = self.token.decode()
+        self.chan.sendall((
+            f"__sshscre_cmd={shlex.quote(cmd)}\n"
+            "__sshscre_run </dev/null\n"
+            "__sshscre_rc=$?\n"
+            f"printf '%s %s %s\\n' {token} \"$__sshscre_rc\" \"$PWD\"\n"
+            f"printf '%s\\n' {token} >&2\n"
+        ).encode())
+        collected_out, collected_err = [], []
+        out = _MarkedStream(self.token + b" ", on_out or collected_out.append, with_status=True)
+        err = _MarkedStream(self.token + b"\n", on_err or collected_err.append)
+        cancelled = None
+        while not (out.done and err.done):
+            try:
+                if self.chan.recv_ready(): out.feed(self.chan.recv(65536))
+                elif self.chan.recv_stderr_ready(): err.feed(self.chan.recv_stderr(65536))
+                elif self.chan.closed or self.chan.eof_received or self.chan.exit_status_ready():
+                    raise EOFError("удалённая оболочка завершилась")
+                elif cancelled and time.time() - cancelled > SHELL_CANCEL_TIMEOUT: return self._abandon()
+                else:
+                    if on_idle: on_idle()
+                    select.select([self.chan], [], [], 0.5)
+            except KeyboardInterrupt:
+                if cancelled: return self._abandon()
+                cancelled = time.time()
+                self.cancel()
+        rc, _, self.cwd = out.status.decode(errors="replace").partition(" ")
+        return "".join(collected_out), "".join(collected_err), int(rc), self.cwd
+
+    # команда не реагирует на сигнал: оболочка пересоздаётся в прежнем каталоге
+    def _abandon(self):
+        console.print("\n⚠️ Команда не завершилась, оболочка перезапущена", style="yellow")
+        self.close()
+        self.start(self.cwd)
+        return "", "", 130, self.cwd
+
+# кеш списков удалённых каталогов за одним SFTP-каналом: автодополнение и проверка cd без запроса к серверу
+class PathCache:
+    def __init__(self, ssh, ttl=PATH_CACHE_TTL):
+        self.ssh = ssh
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.sftp = None
+        self.home = None
+
+    def _sftp(self):
+        if self.sftp is None:
+            self.sftp = open_sftp(self.ssh)
+            self.home = self.home or self.sftp.normalize(".")
+        return self.sftp
+
+    # абсолютный путь: относительные считаются от base, ~ — домашний каталог
+    def resolve(self, path, base):
+        if path == "~" or path.startswith("~/"):
+            if not self.home: self._sftp()
+            path = self.home + path[1:]
+        return posixpath.normpath(posixpath.join(base or "/", path)) if path else (base or "/")
+
+    # {имя: "d" | "l" | "f"} или None, если каталог не читается
+    def listdir(self, path, refresh=False):
+        with self.lock: entry = self.entries.get(path)
+        if entry and not refresh and time.time() - entry[0] < self.ttl: return entry[1]
+        try: attrs = self._sftp().listdir_attr(path)
+        except (IOError, OSError, paramiko.SSHException): listing = None
+        else: listing = {a.filename: "d" if stat.S_ISDIR(a.st_mode or 0) else "l" if stat.S_ISLNK(a.st_mode or 0) else "f" for a in attrs}
+        with self.lock: self.entries[path] = (time.time(), listing)
+        return listing
+
+    def cached(self, path):
+        with self.lock: entry = self.entries.get(path)
+        return entry[1] if entry and time.time() - entry[0] < self.ttl else None
+
+    # подгрузка каталога в фоне, пока пользователь набирает следующую команду
+    def prefetch(self, path):
+        threading.Thread(target=self.listdir, args=(path,), daemon=True).start()
+
+    def invalidate(self, path=None):
+        with self.lock:
+            if path is None: self.entries = {}
+            else:
+                self.entries.pop(path, None)
+                self.entries.pop(posixpath.dirname(path), None)
+
+    # True, только если по свежему кешу родителя точно известно, что такого каталога нет
+    def missing_dir(self, path):
+        if path == "/": return False
+        listing = self.cached(posixpath.dirname(path))
+        return listing is not None and listing.get(posixpath.basename(path)) not in ("d", "l")
+
+    # варианты дополнения для набранного фрагмента пути
+    def complete(self, text, base, dirs_only=False):
+        head, _, prefix = text.rpartition("/")
+        directory = self.resolve(head + "/" if head or text.startswith("/") else "", base)
+        listing = self.listdir(directory) or {}
+        shown = head + "/" if head or text.startswith("/") else ""
+        matches = []
+        for name, kind in sorted(listing.items()):
+            if not name.startswith(prefix) or (name.startswith(".") and not prefix.startswith(".")): continue
+            if dirs_only and kind == "f": continue
+            matches.append(shown + name + ("/" if kind == "d" else ""))
+        return matches
+
+    def close(self):
+        if self.sftp:
+            try: self.sftp.close()
+            except Exception: pass
+        self.sftp = None
+
+# команда могла изменить файлы на сервере
+def changes_tree(cmd):
+    words = cmd.split()
+    return not words or words[0] not in READONLY_COMMANDS or ">" in cmd or "-delete" in words or "-exec" in words
+
+# каталог из простой команды cd без подстановок; для остальных форм — None
+def cd_target(cmd):
+    try: words = shlex.split(cmd)
+    except ValueError: return None
+    if len(words) != 2 or words[0] != "cd" or words[1] == "-" or any(ch in cmd for ch in "$`*?;&|"): return None
+    if words[1].startswith("~") and words[1] != "~" and not words[1].startswith("~/"): return None
+    return words[1]
+
+# Tab в REPL: встроенные команды, каталоги для cd, удалённые и локальные пути для file, удалённые для остального
+class Completer:
+    def __init__(self, paths, cwd):
+        self.paths = paths
+        self.cwd = cwd
+        self.matches = []
+        self.previous = None
+
+    def __call__(self, text, state):
+        if state == 0:
+            try: self.matches = self.candidates(text, readline.get_line_buffer()[:readline.get_begidx()])
+            except Exception: self.matches = []
+        return self.matches[state] if state < len(self.matches) else None
+
+    def candidates(self, text, before):
+        words = before.split()
+        if not words: return [c + " " for c in REPL_COMMANDS if c.startswith(text)]
+        if words[0] == "local":
+            if len(words) == 1: return [c[6:] + " " for c in REPL_COMMANDS if c.startswith("local " + text)]
+            return local_completions(text)
+        if words[0] == "cd": return self.paths.complete(text, self.cwd(), dirs_only=True)
+        if words[0] == "file":
+            options = [o + " " for o in FILE_OPTIONS if text and o.startswith(text)]
+            return list(dict.fromkeys(options + local_completions(text) + self.paths.complete(text, self.paths.home or self.cwd())))
+        return self.paths.complete(text, self.cwd())
+
+    def attach(self):
+        if not readline: return
+        self.previous = readline.get_completer()
+        readline.set_completer(self)
+        readline.set_completer_delims(" \t\n;|&<>")
+        readline.parse_and_bind("bind ^I rl_complete" if "libedit" in (readline.__doc__ or "") else "tab: complete")
+
+    def detach(self):
+        if readline: readline.set_completer(self.previous)
+
+# дополнение локальных путей
+def local_completions(text):
+    head, _, prefix = text.rpartition("/")
+    directory = os.path.expanduser(head or ("/" if text.startswith("/") else "."))
+    try: names = sorted(os.listdir(directory))
+    except OSError: return []
+    shown = head + "/" if head or text.startswith("/") else ""
+    return [shown + n + ("/" if os.path.isdir(os.path.join(directory, n)) else "") for n in names if n.startswith(prefix) and (prefix.startswith(".") or not n.startswith("."))]
+
+# проброс локального порта: счётчики обновляет поток ретранслятора, скорость — раз в секунду
+class Tunnel:
+    def __init__(self, local_host, local_port, remote_host, remote_port):
+        self.local = (local_host, local_port)
+        self.remote = (remote_host, remote_port)
+        self.listener = None
+        self.active = self.total = self.errors = 0
+        self.up = self.down = 0
+        self.up_rate = self.down_rate = 0.0
+        self.sample = (time.time(), 0, 0)
+
+    def measure(self, now):
+        then, up, down = self.sample
+        if now - then < 1: return
+        self.up_rate, self.down_rate = (self.up - up) / (now - then), (self.down - down) / (now - then)
+        self.sample = (now, self.up, self.down)
+
+# пара локальный сокет + direct-tcpip канал с буферами в обе стороны
+class _Relay:
+    def __init__(self, sock, chan, tunnel):
+        self.sock, self.chan, self.tunnel = sock, chan, tunnel
+        self.up, self.down = bytearray(), bytearray()
+        self.sock_eof = self.chan_eof = self.closed = False
+        chan.setblocking(0)
+
+# [адрес:]порт:хост:порт или просто порт (тот же порт на localhost сервера)
+def parse_forward(spec):
+    parts = spec.rsplit(":", 3) if spec.count(":") <= 3 else None
+    if not parts or not all(parts): raise ValueError("Использование: forward [адрес:]порт[:хост:порт]")
+    if len(parts) == 1: return "127.0.0.1", int(parts[0]), "localhost", int(parts[0])
+    if len(parts) == 3: return "127.0.0.1", int(parts[0]), parts[1], int(parts[2])
+    if len(parts) == 4: return parts[0], int(parts[1]), parts[2], int(parts[3])
+    raise ValueError("Использование: forward [адрес:]порт[:хост:порт]")
+
+# все туннели сессии обслуживает один поток с селектором; каналы открываются в небольшом пуле,
+# чтобы рукопожатие direct-tcpip не останавливало ретрансляцию остальных соединений
+class Forwarder:
+    def __init__(self, transport):
+        self.transport = transport
+        self.sel = selectors.DefaultSelector()
+        self.tunnels = []
+        self.relays = set()
+        self.calls = []
+        self.lock = threading.Lock()
+        self.opener = ThreadPoolExecutor(max_workers=FORWARD_OPEN_WORKERS)
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.sel.register(self.wake_r, selectors.EVENT_READ, None)
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def add(self, local_host, local_port, remote_host, remote_port):
+        tunnel = Tunnel(local_host, local_port, remote_host, remote_port)
+        listener = socket.socket(socket.AF_INET6 if ":" in local_host else socket.AF_INET)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listener.bind(tunnel.local)
+            listener.listen(128)
+        except OSError:
+            listener.close()
+            raise
+        listener.setblocking(False)
+        tunnel.listener = listener
+        self._call(lambda: self.sel.register(listener, selectors.EVENT_READ, tunnel))
+        self.tunnels.append(tunnel)
+        return tunnel
+
+    def stop(self, tunnel):
+        def close():
+            self.sel.unregister(tunnel.listener)
+            tunnel.listener.close()
+            for relay in [r for r in self.relays if r.tunnel is tunnel]: self._close(relay)
+        self.tunnels.remove(tunnel)
+        self._call(close, wait=True)
+
+    # соединение переоткрыто: туннели остаются на своих портах, соединения старого транспорта закрываются
+    def rebind(self, transport):
+        self.transport = transport
+        self._call(lambda: [self._close(relay) for relay in list(self.relays)], wait=True)
+
+    def close(self):
+        for tunnel in list(self.tunnels): self.stop(tunnel)
+        self._call(lambda: setattr(self, "running", False))
+        self.thread.join(timeout=2)
+        self.opener.shutdown(wait=False)
+        self.wake_r.close()
+        self.wake_w.close()
+
+    # изменения селектора выполняются только в его потоке; wait — дождаться выполнения
+    def _call(self, fn, wait=False):
+        done = threading.Event()
+        def call():
+            try: fn()
+            finally: done.set()
+        with self.lock: self.calls.append(call)
+        try: self.wake_w.send(b"\0")
+        except OSError: pass
+        if wait and threading.current_thread() is not self.thread: done.wait(2)
+
+    def _loop(self):
+        while self.running:
+            waiting = any(r.up and not r.closed for r in self.relays)
+            for key, mask in self.sel.select(0.02 if waiting else 0.5):
+                data = key.data
+                if data is None:
+                    try: self.wake_r.recv(4096)
+                    except OSError: pass
+                elif isinstance(data, Tunnel): self._accept(data)
+                else:
+                    relay, side = data
+                    if not relay.closed: self._pump(relay, side, mask)
+            with self.lock: calls, self.calls = self.calls, []
+            for fn in calls: fn()
+            # окно канала могло открыться: досылка без события на дескрипторе;
+            # канал, закрытый сервером после EOF, событий больше не даёт
+            for relay in [r for r in self.relays if r.up or (r.chan_eof and r.chan.closed)]: self._pump(relay, "chan", 0)
+            now = time.time()
+            for tunnel in self.tunnels: tunnel.measure(now)
+        for relay in list(self.relays): self._close(relay)
+        self.sel.close()
+
+    def _accept(self, tunnel):
+        try: sock, addr = tunnel.listener.accept()
+        except OSError: return
+        sock.setblocking(False)
+        tunnel.active += 1
+        tunnel.total += 1
+        def open_channel():
+            try: chan = self.transport.open_channel("direct-tcpip", tunnel.remote, addr[:2], timeout=CHANNEL_OPEN_TIMEOUT)
+            except Exception:
+                self._call(lambda: self._reject(sock, tunnel))
+                return
+            self._call(lambda: self._attach(_Relay(sock, chan, tunnel)))
+        self.opener.submit(open_channel)
+
+    def _reject(self, sock, tunnel):
+        tunnel.active -= 1
+        tunnel.errors += 1
+        sock.close()
+
+    def _attach(self, relay):
+        self.relays.add(relay)
+        self.sel.register(relay.sock, selectors.EVENT_READ, (relay, "sock"))
+        self.sel.register(relay.chan, selectors.EVENT_READ, (relay, "chan"))
+
+    def _pump(self, relay, side, mask):
+        tunnel = relay.tunnel
+        try:
+            if side == "sock" and mask & selectors.EVENT_READ and len(relay.up) < FORWARD_BUFFER:
+                data = relay.sock.recv(CHUNK_SIZE)
+                if data:
+                    relay.up += data
+                    tunnel.up += len(data)
+                else: relay.sock_eof = True
+            if side == "chan" and mask & selectors.EVENT_READ and len(relay.down) < FORWARD_BUFFER:
+                try: data = relay.chan.recv(CHUNK_SIZE)
+                except socket.timeout: data = None
+                if data:
+                    relay.down += data
+                    tunnel.down += len(data)
+                elif data is not None: relay.chan_eof = True
+            while relay.up and relay.chan.send_ready():
+                del relay.up[:relay.chan.send(bytes(relay.up[:CHUNK_SIZE]))]
+            if relay.down:
+                try: del relay.down[:relay.sock.send(relay.down)]
+                except BlockingIOError: pass
+        except (OSError, EOFError, paramiko.SSHException):
+            self._close(relay)
+            return
+        if relay.sock_eof and not relay.up and not relay.chan.eof_sent: relay.chan.shutdown_write()
+        if relay.chan_eof and not relay.down:
+            if relay.sock_eof or relay.chan.closed:
+                self._close(relay)
+                return
+            try: relay.sock.shutdown(socket.SHUT_WR)
+            except OSError: pass
+        self._watch(relay)
+
+    # интерес к событиям по заполненности буферов: полный буфер не читается дальше
+    def _watch(self, relay):
+        sock_events = (selectors.EVENT_READ if not relay.sock_eof and len(relay.up) < FORWARD_BUFFER else 0) | (selectors.EVENT_WRITE if relay.down else 0)
+        chan_events = selectors.EVENT_READ if not relay.chan_eof and len(relay.down) < FORWARD_BUFFER else 0
+        for fileobj, events, side in ((relay.sock, sock_events, "sock"), (relay.chan, chan_events, "chan")):
+            try: registered = self.sel.get_key(fileobj).events
+            except KeyError: registered = 0
+            if events == registered: continue
+            if not events: self.sel.unregister(fileobj)
+            elif not registered: self.sel.register(fileobj, events, (relay, side))
+            else: self.sel.modify(fileobj, events, (relay, side))
+
+    def _close(self, relay):
+        if relay.closed: return
+        relay.closed = True
+        relay.tunnel.active -= 1
+        self.relays.discard(relay)
+        for fileobj in (relay.sock, relay.chan):
+            try: self.sel.unregister(fileobj)
+            except (KeyError, ValueError): pass
+            try: fileobj.close()
+            except Exception: pass
+
+# таблица туннелей
+def forward_table(forwarder):
+    t = Table(title="🔀 Туннели", box=box.ROUNDED)
+    for col in ["#", "Локально", "Удалённо", "Соединений", "↑ /с", "↓ /с", "Передано", "Ошибки"]: t.add_column(col)
+    for i, tunnel in enumerate(forwarder.tunnels, 1):
+        t.add_row(str(i), f"{tunnel.local[0]}:{tunnel.local[1]}", f"{tunnel.remote[0]}:{tunnel.remote[1]}", f"{tunnel.active} / {tunnel.total}",
+                  human_size(tunnel.up_rate), human_size(tunnel.down_rate), f"↑ {human_size(tunnel.up)}  ↓ {human_size(tunnel.down)}", str(tunnel.errors))
+    return t
+
+# команда forward: forward <спец> | forward list | forward watch | forward stop <номер>
+def handle_forward_cmd(forwarder, args):
+    args = args.strip()
+    if args in ("", "list"):
+        if forwarder.tunnels: console.print(forward_table(forwarder))
+        else: console.print("Туннелей нет. Использование: forward [адрес:]порт[:хост:порт]", style="yellow")
+    elif args == "watch":
+        try:
+            with Live(forward_table(forwarder), console=console, refresh_per_second=2) as live:
+                while True:
+                    time.sleep(1)
+                    live.update(forward_table(forwarder))
+        except KeyboardInterrupt: pass
+    elif args.startswith("stop"):
+        try: tunnel = forwarder.tunnels[int(args[4:]) - 1]
+        except (ValueError, IndexError):
+            console.print("❌ Использование: forward stop <номер>", style="red")
+            return
+        forwarder.stop(tunnel)
+        console.print(f"⏹ Туннель {tunnel.local[0]}:{tunnel.local[1]} остановлен", style="yellow")
+    else:
+        try: tunnel = forwarder.add(*parse_forward(args))
+        except ValueError as e:
+            console.print(f"❌ {e}", style="red")
+            return
+        except OSError as e:
+            console.print(f"❌ Не удалось открыть локальный порт: {e}", style="red")
+            return
+        console.print(f"🔀 {tunnel.local[0]}:{tunnel.local[1]} → {tunnel.remote[0]}:{tunnel.remote[1]} через SSH", style="green")
+
+# хост может содержать порт: host:port или [ipv6]:port
+def split_host(host):
+    if host.startswith("[") and "]:" in host:
+        h, _, port = host[1:].partition("]:")
+        return h, int(port)
+    if host.count(":") == 1:
+        h, _, port = host.partition(":")
+        return h, int(port)
+    return host.strip("[]"), 22
+
+# SSH-клиент с авторизацией по паролю или ключу
+def open_client(server):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    host, port = split_host(server["host"])
+    profile = server.get("transport") or {}
+    options = connect_options(profile)
+    if server["auth_type"] == "password":
+        ssh.connect(host, port=port, username=server["user"], password=vault.password(server), timeout=10, **options)
+    elif server["auth_type"] == "key":
+        ssh.connect(host, port=port, username=server["user"], key_filename=server["key_path"], timeout=10, **options)
+    apply_windows(ssh.get_transport(), profile)
+    return ssh
+
+# параметры рукопожатия из профиля: шифры перед выбранным отключаются, и он идёт первым,
+# остальные остаются запасными
+def connect_options(profile):
+    preferred = paramiko.Transport._preferred_ciphers
+    cipher = profile.get("cipher")
+    disabled = list(preferred[:preferred.index(cipher)]) if cipher in preferred else []
+    return {"disabled_algorithms": {"ciphers": disabled}, "compress": bool(profile.get("compress"))}
+
+# окно и размер пакета для всех следующих каналов транспорта (оболочка, SFTP, exec, туннели)
+def apply_windows(transport, profile):
+    if profile.get("window"): transport.default_window_size = profile["window"]
+    if profile.get("packet"): transport.default_max_packet_size = profile["packet"]
+
+# смена шифра и сжатия на живом транспорте повторным обменом ключами;
+# возвращает фактически согласованные (шифр, сжатие)
+def rekey(transport, cipher, compress):
+    options = transport.get_security_options()
+    transport.disabled_algorithms = dict(transport.disabled_algorithms, ciphers=[])
+    if cipher in options.ciphers: options.ciphers = (cipher,) + tuple(c for c in options.ciphers if c != cipher)
+    transport.use_compression(compress)
+    transport.renegotiate_keys()
+    return transport.remote_cipher, transport.remote_compression not in (None, "none")
+
+# настройки по умолчанию на живом транспорте: порядок шифров paramiko без отключённых, без сжатия,
+# стандартные окно и пакет; соединение из пула продолжает работать уже с ними
+def reset_transport(transport):
+    transport.disabled_algorithms = dict(transport.disabled_algorithms, ciphers=[])
+    transport.get_security_options().ciphers = paramiko.Transport._preferred_ciphers
+    transport.use_compression(False)
+    transport.renegotiate_keys()
+    transport.default_window_size = paramiko.common.DEFAULT_WINDOW_SIZE
+    transport.default_max_packet_size = paramiko.common.DEFAULT_MAX_PACKET_SIZE
+
+# задержка (медиана пустых команд) и скорость потока с сервера на окне и пакете кандидата
+def measure_transport(transport, window, packet, size=TUNE_BYTES, seconds=TUNE_SECONDS):
+    latencies = []
+    for _ in range(TUNE_PINGS):
+        started = time.time()
+        chan = transport.open_session(timeout=CHANNEL_OPEN_TIMEOUT)
+        chan.exec_command("true")
+        chan.recv_exit_status()
+        chan.close()
+        latencies.append(time.time() - started)
+    chan = transport.open_session(window_size=window, max_packet_size=packet, timeout=CHANNEL_OPEN_TIMEOUT)
+    chan.exec_command(TUNE_STREAM.format(size=size))
+    received, started = 0, time.time()
+    try:
+        while time.time() - started < seconds:
+            data = chan.recv(FORWARD_BUFFER)
+            if not data: break
+            received += len(data)
+    finally: chan.close()
+    return received / max(time.time() - started, 1e-6), sorted(latencies)[len(latencies) // 2]
+
+# подбор профиля по очереди: окно, пакет, шифр, сжатие. Кандидат принимается, если быстрее
+# текущего лучшего хотя бы на TUNE_MARGIN и задержка не хуже больше чем на TUNE_LATENCY_MARGIN,
+# либо если задержка заметно меньше при той же скорости. Лучший профиль сразу применяется
+def tune_transport(transport, report=None):
+    best = {"cipher": transport.remote_cipher, "compress": transport.remote_compression not in (None, "none"),
+            "window": transport.default_window_size, "packet": transport.default_max_packet_size}
+    results, tried, top, low = [], set(), 0, None
+
+    def trial(candidate, rekeyed=False):
+        nonlocal top, low
+        if rekeyed: candidate["cipher"], candidate["compress"] = rekey(transport, candidate["cipher"], candidate["compress"])
+        key = tuple(sorted(candidate.items()))
+        if key in tried: return
+        tried.add(key)
+        speed, latency = measure_transport(transport, candidate["window"], candidate["packet"])
+        results.append(dict(candidate, speed=speed, latency=latency))
+        if report: report(results[-1])
+        if low is None: accept = True
+        else:
+            slower_ping = latency > low * TUNE_LATENCY_MARGIN + TUNE_LATENCY_SLACK
+            quicker_ping = latency * TUNE_LATENCY_MARGIN + TUNE_LATENCY_SLACK < low
+            accept = (speed > top * TUNE_MARGIN and not slower_ping) or (quicker_ping and speed * TUNE_MARGIN >= top)
+        if accept:
+            top, low = speed, latency
+            best.update(candidate)
+
+    trial(dict(best))
+    for window in TUNE_WINDOWS: trial(dict(best, window=window))
+    for packet in TUNE_PACKETS: trial(dict(best, packet=packet))
+    for cipher in TUNE_CIPHERS:
+        if cipher in transport.get_security_options().ciphers: trial(dict(best, cipher=cipher), rekeyed=True)
+    trial(dict(best, compress=not best["compress"]), rekeyed=True)
+    rekey(transport, best["cipher"], best["compress"])
+    apply_windows(transport, best)
+    return best, results
+
+# строка профиля для вывода
+def describe_profile(profile):
+    if not profile: return "по умолчанию"
+    return f"{profile['cipher']}, сжатие {'вкл' if profile['compress'] else 'выкл'}, окно {human_size(profile['window'])}, пакет {human_size(profile['packet'])}"
+
+# tune в сессии: замер кандидатов на текущем соединении, лучший профиль сохраняется для сервера
+def tune_server(server, ssh, args=""):
+    if args not in ("", "show", "reset"):
+        console.print("❌ Использование: tune [show|reset]", style="red", markup=False)
+        return
+    if args == "reset":
+        server["transport"] = {}
+        db.set_transport(server["id"], {})
+        try: reset_transport(ssh.get_transport())
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            console.print(f"⚠️ Профиль сброшен, но к текущему соединению не применён: {e}", style="yellow")
+            return
+        console.print("→ Профиль сброшен и применён к текущему соединению", style="dim")
+        return
+    if args == "show":
+        console.print(f"→ Профиль: {describe_profile(server.get('transport'))}", style="cyan")
+        return
+    t = Table(title="Замер транспорта", box=box.SIMPLE)
+    for col in ["Шифр", "Сжатие", "Окно", "Пакет", "Скорость", "Задержка"]: t.add_column(col)
+    def report(result):
+        t.add_row(result["cipher"], "вкл" if result["compress"] else "выкл", human_size(result["window"]), human_size(result["packet"]),
+                  f"{human_size(result['speed'])}/с", f"{result['latency'] * 1000:.0f} мс")
+    try:
+        with Live(t, console=console, refresh_per_second=4): best, _ = tune_transport(ssh.get_transport(), report)
+    except (paramiko.SSHException, EOFError, OSError) as e:
+        console.print(f"❌ Замер прерван: {e}", style="red")
+        return
+    server["transport"] = best
+    db.set_transport(server["id"], best)
+    console.print(f"✅ Профиль сохранён и применён: {describe_profile(best)}", style="green")
+
+# соединение действительно отвечает: канал открывается за CHANNEL_OPEN_TIMEOUT
+def responsive(client):
+    try: client.get_transport().open_session(timeout=CHANNEL_OPEN_TIMEOUT).close()
+    except (paramiko.SSHException, EOFError, OSError): return False
+    return True
+
+# пул авторизованных соединений: транспорт живёт между сессиями с keepalive,
+# простаивающие закрываются, мёртвые заменяются новыми при следующем запросе
+class ConnectionPool:
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT, keepalive=POOL_KEEPALIVE):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.connecting = {}
+        self.reaper = None
+
+    @staticmethod
+    def key(server):
+        return (server["host"], server["user"], server.get("auth_type"), server.get("key_path"))
+
+    def alive(self, server):
+        entry = self.entries.get(self.key(server))
+        return bool(entry and entry["client"].get_transport() and entry["client"].get_transport().is_active())
+
+    # клиент для сервера: из пула без рукопожатия, если транспорт жив, иначе новое подключение.
+    # После сна или смены сети is_active() ещё True, поэтому простоявший дольше POOL_VERIFY_IDLE
+    # транспорт сначала проверяется открытием канала с таймаутом
+    def get(self, server, reconnect=False):
+        self.evict_idle()
+        key = self.key(server)
+        check = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and not reconnect and self.alive(server):
+                idle, entry["used"] = time.time() - entry["used"], time.time()
+                if idle < POOL_VERIFY_IDLE: return entry["client"]
+                check = entry
+            stale = entry if reconnect else None
+        if check:
+            if responsive(check["client"]): return check["client"]
+            stale = check
+        with self.lock: connecting = self.connecting.setdefault(key, threading.Lock())
+        # параллельные запросы к одному серверу ждут одно рукопожатие, а не открывают свои
+        with connecting:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry is not stale and self.alive(server):
+                    entry["used"] = time.time()
+                    return entry["client"]
+            client = open_client(server)
+            client.get_transport().set_keepalive(self.keepalive)
+            with self.lock:
+                old = self.entries.get(key)
+                self.entries[key] = {"client": client, "users": old["users"] if old else 0, "used": time.time()}
+                if self.reaper is None:
+                    self.reaper = threading.Thread(target=self._reap, daemon=True)
+                    self.reaper.start()
+        if old: self._close(old["client"])
+        return client
+
+    # клиент на время сессии: пока сессия открыта, соединение не вытесняется
+    def acquire(self, server, reconnect=False):
+        client = self.get(server, reconnect)
+        with self.lock: self.entries[self.key(server)]["users"] += 1
+        return client
+
+    # сессия закончилась, соединение остаётся в пуле
+    def release(self, server):
+        with self.lock:
+            entry = self.entries.get(self.key(server))
+            if entry:
+                entry["users"] = max(0, entry["users"] - 1)
+                entry["used"] = time.time()
+
+    # client не отвечает: если в пуле его уже заменили живым — берётся тот, иначе переподключение
+    def replace(self, server, client):
+        fresh = self.get(server)
+        return fresh if fresh is not client else self.get(server, reconnect=True)
+
+    # канал из пула; если транспорт умер незаметно, подключение повторяется один раз
+    def channel(self, server):
+        try: return self.get(server).get_transport().open_session(timeout=CHANNEL_OPEN_TIMEOUT)
+        except (paramiko.SSHException, EOFError, OSError):
+            return self.get(server, reconnect=True).get_transport().open_session(timeout=CHANNEL_OPEN_TIMEOUT)
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            stale = [k for k, e in self.entries.items() if not e["users"] and now - e["used"] > self.idle_timeout]
+            clients = [self.entries.pop(k)["client"] for k in stale]
+        for client in clients: self._close(client)
+
+    def close_all(self):
+        with self.lock:
+            clients = [e["client"] for e in self.entries.values()]
+            self.entries = {}
+        for client in clients: self._close(client)
+
+    def _reap(self):
+        while True:
+            time.sleep(self.keepalive)
+            self.evict_idle()
+
+    @staticmethod
+    def _close(client):
+        try: client.close()
+        except Exception: pass
+
+pool = ConnectionPool()
+
+# прогрев, пока открыто меню: в фоне загружается paramiko, разрешаются имена и в пул
+# открываются соединения к последним серверам. Пароль расшифровывается, только если
+# для этого не нужен мастер-пароль; ошибки не показываются — подключение из меню их повторит
+def prewarm(limit=PREWARM_SERVERS):
+    def warm(server):
+        try:
+            host, port = split_host(server["host"])
+            socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+            if server.get("secret") and not vault.cipher and vault.protected(): return
+            pool.get(server)
+        except Exception: pass
+    def run():
+        paramiko.load()
+        servers = db.recent_servers(limit) if limit else []
+        if not servers: return
+        with ThreadPoolExecutor(max_workers=len(servers)) as ex: list(ex.map(warm, servers))
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+# оболочка на соединении из пула; незаметно умерший транспорт заменяется новым один раз
+def open_shell(server, ssh, cwd=None, oldpwd=None):
+    try: return ssh, RemoteShell(ssh, cwd, oldpwd)
+    except (paramiko.SSHException, EOFError, OSError):
+        ssh = pool.replace(server, ssh)
+        return ssh, RemoteShell(ssh, cwd, oldpwd)
+
+# функция в фоновом потоке; результат или исключение — через Future
+def in_background(fn, *args):
+    future = Future()
+    def run():
+        try: future.set_result(fn(*args))
+        except BaseException as e: future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+# оболочка готова: сверка кеша с сервером; возвращает (имя хоста, текущий каталог)
+def shell_ready(server, shell, target):
+    if shell.cd_error: console.print(f"❌ Ошибка перехода в {target}: {shell.cd_error}", style="red")
+    db.save_server_state(server["id"], hostname=shell.hostname, home=shell.home, cwd=shell.cwd)
+    server["real_hostname"] = shell.hostname or server["host"]
+    return server["real_hostname"], shell.cwd or "/"
+
 # подключение к серверу
 def connect_to_server(server):
+    history = paths = completer = forwarder = None
+    started = time.time()
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
-        if server["auth_type"] == "password":
-            ssh.connect(server["host"], username=server["user"], password=server["password"], timeout=10)
-        elif server["auth_type"] == "key":
-            ssh.connect(server["host"], username=server["user"], key_filename=server["key_path"], timeout=10)
-        
-        _, out, _ = ssh.exec_command("hostname")
-        real_host = out.read().decode().strip() or server["host"]
+        warm = pool.alive(server)
+        ssh = pool.acquire(server)
+        # промпт сразу после авторизации по данным прошлого подключения;
+        # оболочка стартует и сверяет их в фоне одним запросом
+        state = db.server_state(server["id"])
+        target = server.pop("session_cwd", None)
+        starting = in_background(open_shell, server, ssh, target, state.get("cwd"))
+        shell = None
+        real_host = state.get("hostname") or server["host"]
+        last_cwd = target or state.get("home") or "/"
         server["real_hostname"] = real_host
-
-        _, out, _ = ssh.exec_command("pwd")
-        current_dir = out.read().decode().strip() or "/"
-        
-        last_cwd = current_dir
-        if "session_cwd" in server:
-            full_cmd = f"cd {server['session_cwd']} && pwd"
-            _, out, err = ssh.exec_command(full_cmd)
-            output = out.read().decode().strip()
-            error = err.read().decode().strip()
-            if error: console.print(f"❌ Ошибка перехода в {server['session_cwd']}: {error}", style="red")
-            else: last_cwd = output
-            del server["session_cwd"]
         
-        short_dir = last_cwd.split("/")[-1] if last_cwd != "/" else "~"
-        console.print(f"✅ Подключено к {server['name']} → {real_host}", style="blue")
-        show_infovds(ssh)
+        if server.get("show_info", True): show_infovds(ssh, server)
+        # замер до вопроса о настройке: раздумья пользователя и provision в метрику не входят
+        to_prompt = time.time() - started
         
         if not server.get("setup_done"):
             if Confirm.ask("🔧 Первый запуск. Настроить сервер?"):
-                setup_server(ssh, server["os"])
-                server["setup_done"] = True
-                servers = load_servers()
-                for s in servers:
-                    if s["id"] == server["id"]:
-                        s.update(server)
-                save_servers(servers)
+                provision([server])
         
-        console.print("\n→ Команды: exit, infovds, file, clear, cls, cd, local ls, local history, dash, undash", style="bold cyan")
+        db.record_connect(server["id"], to_prompt, warm)
+        console.print(f"✅ Подключено к {server['name']} → {real_host} за {to_prompt:.2f} с", style="blue")
         
+        console.print("\n→ Команды: exit, infovds [--watch N|--refresh|--auto on/off], file, clear, cls, cd, local ls, local history [grep текст] [--all], !n, !!, forward [порт|list|watch|stop N], tune [show|reset], dash, undash", style="bold cyan", markup=False)
+        
+        history = History(server["id"])
+        history.attach_readline()
+        paths = PathCache(ssh)
+        paths.home = state.get("home")
+        paths.prefetch(last_cwd)
+        completer = Completer(paths, lambda: last_cwd)
+        completer.attach()
         use_dash_prompt = False
         while True:
+            if starting is not None and starting.done():
+                ssh, shell = starting.result()
+                starting = None
+                real_host, last_cwd = shell_ready(server, shell, target)
             prompt_symbol = "#" if use_dash_prompt else "$"
             prompt_display = last_cwd.split("/")[-1] if last_cwd != "/" else "~"
             cmd = Prompt.ask(f"{server['user']}@{real_host}/{prompt_display} {prompt_symbol} ", style="green").strip()
             
-            if cmd and cmd != "local history":
-                with open(HISTORY_FILE, "a") as f: f.write(cmd + "\n")
+            # как в bash: после ! пробел, = или ( — это не ссылка на историю, строка уходит в оболочку
+            if cmd.startswith("!") and len(cmd) > 1 and not cmd[1].isspace() and cmd[1] not in "=(":
+                recalled = history.expand(cmd)
+                if recalled is None:
+                    console.print(f"❌ {cmd}: нет такой команды в истории", style="red", markup=False)
+                    continue
+                console.print(recalled, style="dim", markup=False, highlight=False)
+                if readline and readline.get_current_history_length(): readline.replace_history_item(readline.get_current_history_length() - 1, recalled)
+                cmd = recalled
+            if cmd and not cmd.startswith("local history"): history.add(cmd)
             
             if not cmd: continue
             elif cmd in ("exit", "quit", "q"): break
-            elif cmd == "infovds": show_infovds(ssh)
+            elif cmd == "infovds": show_infovds(ssh, server)
+            elif cmd == "infovds --refresh": show_infovds(ssh, server, refresh=True)
+            elif cmd in ("infovds --auto on", "infovds --auto off"):
+                server["show_info"] = cmd.endswith("on")
+                db.set_show_info(server["id"], server["show_info"])
+                console.print(f"→ Панель infovds при подключении {'включена' if server['show_info'] else 'отключена'}", style="dim")
+            elif cmd.startswith("infovds --watch"):
+                try:
+                    interval = float(cmd[15:].strip() or INFO_WATCH_INTERVAL)
+                    if not interval > 0: raise ValueError
+                except ValueError: console.print("❌ Использование: infovds --watch [секунды]", style="red")
+                else: watch_infovds(ssh, server, interval)
             elif cmd == "dash": 
                 use_dash_prompt = True
                 console.print("→ Переключён на dash-стиль промпта", style="dim")
@@ -321,40 +2401,60 @@ def connect_to_server(server):
                 use_dash_prompt = False
                 console.print("→ Стандартный промпт активирован", style="dim")
             elif cmd == "clear" or cmd == "cls": os.system('cls' if os.name == 'nt' else 'clear')
-            elif cmd.startswith("cd "):
-                target = cmd[3:].strip()
-                if not target: full_cmd = "cd && pwd"
-                else: full_cmd = f"cd {target} && pwd"
-                _, out, err = ssh.exec_command(full_cmd)
-                output = out.read().decode().strip()
-                error = err.read().decode().strip()
-                if error: console.print(error, style="red")
-                else: last_cwd = output
+            elif cmd == "tune" or cmd.startswith("tune "): tune_server(server, ssh, cmd[4:].strip())
+            elif cmd == "forward" or cmd.startswith("forward "):
+                forwarder = forwarder or Forwarder(ssh.get_transport())
+                handle_forward_cmd(forwarder, cmd[7:])
+            elif cmd == "file ls" or cmd.startswith("file ls "): list_remote_tree(ssh, cmd[7:].strip() or last_cwd)
             elif cmd.startswith("file "):
-                parts = cmd.split(maxsplit=2)
-                if len(parts) < 3: console.print("❌ Использование: file <источник> <назначение>", style="red")
-                else: handle_file_cmd(ssh, parts[1], parts[2])
+                try: opts, src, dst = parse_file_args(cmd[5:])
+                except ValueError as e: console.print(f"❌ {e}", style="red")
+                else:
+                    handle_file_cmd(ssh, src, dst, opts)
+                    paths.invalidate()
             elif cmd.startswith("local ls"):
                 path = cmd[8:].strip() or "."
                 try: 
                     for item in os.listdir(path): console.print(f"  {item}")
                 except Exception as e: console.print(f"❌ local ls: {e}", style="red")
-            elif cmd == "local history":
-                if os.path.exists(HISTORY_FILE):
-                    with open(HISTORY_FILE, "r") as f: history = f.read().splitlines()
-                    if history:
-                        for i, line in enumerate(history, 1): console.print(f"{i}. {line}")
-                    else: console.print("История команд пуста", style="yellow")
-                else: console.print("История команд пуста", style="yellow")
+            elif cmd.startswith("local history"): show_history(history, cmd[13:])
+            elif cd_target(cmd) and paths.missing_dir(paths.resolve(cd_target(cmd), last_cwd)):
+                console.print(f"❌ cd: {cd_target(cmd)}: нет такого каталога", style="red", markup=False)
             else:
-                full_cmd = f"cd {last_cwd} 2>/dev/null && {cmd}"
-                _, out, err = ssh.exec_command(full_cmd)
-                output = out.read().decode()
-                error = err.read().decode()
-                if output: console.print(output)
-                if error: console.print(error, style="red")
+                if starting is not None:
+                    ssh, shell = starting.result()
+                    starting = None
+                    real_host, last_cwd = shell_ready(server, shell, target)
+                printer = StreamPrinter()
+                try: _, _, rc, last_cwd = shell.run(cmd, printer.out, printer.err, printer.flush)
+                except (EOFError, OSError, paramiko.SSHException):
+                    printer.finish()
+                    # оболочка или всё соединение: open_shell сам переподключится через пул, если транспорт мёртв
+                    shell.close()
+                    fresh, shell = open_shell(server, ssh, last_cwd)
+                    console.print("⚠️ Соединение потеряно, переподключено" if fresh is not ssh else "⚠️ Оболочка завершилась, открыта новая", style="yellow")
+                    if fresh is not ssh:
+                        ssh = fresh
+                        paths.close()
+                        paths = completer.paths = PathCache(ssh)
+                        paths.home = shell.home
+                        if forwarder: forwarder.rebind(ssh.get_transport())
+                    continue
+                printer.finish()
+                if rc: console.print(f"[код {rc}]", style="dim", markup=False)
+                if changes_tree(cmd): paths.invalidate()
+                elif cmd.split()[0] == "cd" and not rc: paths.prefetch(last_cwd)
         
-        ssh.close()
+        if forwarder: forwarder.close()
+        completer.detach()
+        paths.close()
+        history.detach_readline()
+        if starting is not None:
+            ssh, shell = starting.result()
+            real_host, last_cwd = shell_ready(server, shell, target)
+        shell.close()
+        db.save_server_state(server["id"], cwd=last_cwd)
+        pool.release(server)
         console.print("🔌 Отключено", style="red")
         
         if Confirm.ask("💾 Сохранить сессию?"):
@@ -363,6 +2463,11 @@ def connect_to_server(server):
             console.print(f"✅ Сессия '{sess_name}' сохранена", style="green")
     
     except Exception as e:
+        if forwarder: forwarder.close()
+        if completer: completer.detach()
+        if paths: paths.close()
+        if history: history.detach_readline()
+        pool.release(server)
         console.print(f"❌ Ошибка подключения: {e}", style="red")
 
 # добавление сервера
@@ -379,6 +2484,9 @@ def add_server():
     else:
         pwd = None
         key_path = Prompt.ask("Путь к приватному ключу")
+    tags = [t.strip() for t in Prompt.ask("Теги через запятую", default="").split(",") if t.strip()]
+    group = Prompt.ask("Группа", default="").strip()
+    show_info = Confirm.ask("Показывать infovds при подключении?", default=True)
     
     server = {
         "name": name,
@@ -388,102 +2496,476 @@ def add_server():
         "os": os_choice,
         "setup_done": False,
         "auth_type": auth_type,
-        "key_path": key_path
+        "key_path": key_path,
+        "group": group,
+        "show_info": show_info,
+        "tags": tags
     }
     
-    servers = load_servers()
-    servers.append(server)
-    save_servers(servers)
+    db.save_server(server)
     console.print(f"✅ Сервер {name} добавлен", style="green")
 
-# список серверов
-def list_servers():
-    servers = load_servers()
-    if not servers:
-        console.print("Нет серверов", style="yellow")
-        return
-    t = Table(title="Серверы")
-    for col in ["#", "Имя", "IP", "Пользователь", "ОС", "Аутентификация", "Настроено?"]: 
+# таблица одной страницы инвентаря
+def render_servers(rows, offset=0, title="Серверы"):
+    t = Table(title=title)
+    for col in ["#", "Имя", "IP", "Пользователь", "ОС", "Аутентификация", "Настроено?", "Группа", "Теги"]: 
         t.add_column(col)
-    for i, s in enumerate(servers, 1):
+    for i, s in enumerate(rows, offset + 1):
         auth_type = "🔑 Ключ" if s["auth_type"] == "key" else "🔑 Пароль"
         setup = "✅" if s.get("setup_done") else "❌"
-        t.add_row(str(i), s["name"], s["host"], s["user"], s["os"], auth_type, setup)
+        t.add_row(str(i), s["name"], s["host"], s["user"], s["os"], auth_type, setup, s.get("group", ""), ", ".join(s.get("tags", [])))
     console.print(t)
 
+# постраничный просмотр с поиском; в базе читается и расшифровывается только выбранный сервер
+def browse_servers(pick=False):
+    labels = {"text": "поиск", "tag": "тег", "group": "группа"}
+    filters, page = {}, 0
+    while True:
+        rows, total = db.inventory(offset=page * INVENTORY_PAGE, limit=INVENTORY_PAGE, **filters)
+        pages = max(1, -(-total // INVENTORY_PAGE))
+        if page >= pages:
+            page = pages - 1
+            continue
+        if not total and not filters:
+            console.print("Нет серверов" if not pick else "Добавьте сервер", style="yellow" if not pick else "red")
+            return None
+        title = f"Серверы: {total}"
+        if filters: title += " | " + ", ".join(f"{labels[k]}: {v}" for k, v in filters.items())
+        if pages > 1: title += f" | стр. {page + 1}/{pages}"
+        render_servers(rows, page * INVENTORY_PAGE, title)
+        if pages == 1 and not filters and not pick: return None
+        console.print("n/p — страницы, /текст — поиск по имени и IP, tag:тег, group:группа, * — сбросить фильтр, q — назад", style="dim")
+        answer = Prompt.ask("Номер" if pick else "→").strip()
+        if answer in ("", "q"): return None
+        elif answer == "n": page = min(page + 1, pages - 1)
+        elif answer == "p": page = max(page - 1, 0)
+        elif answer == "*": filters, page = {}, 0
+        elif answer.startswith("/"): filters, page = dict(filters, text=answer[1:]), 0
+        elif answer.startswith("tag:"): filters, page = dict(filters, tag=answer[4:]), 0
+        elif answer.startswith("group:"): filters, page = dict(filters, group=answer[6:]), 0
+        elif answer.isdigit() and pick:
+            found = db.inventory(offset=int(answer) - 1, limit=1, **filters)[0] if int(answer) >= 1 else []
+            if found: return db.server(found[0]["id"])
+            console.print("Неверный номер", style="red")
+        else: console.print("Неизвестная команда", style="red")
+
+# список серверов
+def list_servers():
+    browse_servers()
+
+# теги и группы со счётчиками вместо полного списка
+def show_labels():
+    tags, groups = db.labels()
+    total = db.inventory(limit=0)[1]
+    console.print(f"Серверов: {total}", style="bold")
+    if tags: console.print("Теги: " + ", ".join(f"{tag} ({count})" for tag, count in tags), style="cyan")
+    if groups: console.print("Группы: " + ", ".join(f"{group} ({count})" for group, count in groups), style="cyan")
+
 # восстановление сессии
 def restore_session():
-    sessions = load_sessions()
-    if not sessions:
+    rows = db.query('''
+        SELECT sessions.name, sessions.cwd, sessions.server_id, servers.user, servers.host
+        FROM sessions LEFT JOIN servers ON servers.id = sessions.server_id ORDER BY sessions.id
+    ''')
+    if not rows:
         console.print("Нет сохранённых сессий", style="yellow")
         return None
     t = Table(title="Сессии")
     t.add_column("#"); t.add_column("Имя"); t.add_column("Сервер"); t.add_column("Путь")
-    servers = load_servers()
-    for i, (name, data) in enumerate(sessions.items(), 1):
-        server = next((s for s in servers if s["id"] == data["server_id"]), None)
-        if server:
-            t.add_row(str(i), name, f"{server['user']}@{server['host']}", data["cwd"])
-        else:
-            t.add_row(str(i), name, "Сервер не найден", data["cwd"])
+    for i, row in enumerate(rows, 1):
+        target = f"{row['user']}@{row['host']}" if row["host"] is not None else "Сервер не найден"
+        t.add_row(str(i), row["name"], target, row["cwd"])
     console.print(t)
     try:
         idx = int(Prompt.ask("Номер сессии")) - 1
-        session_names = list(sessions.keys())
-        if idx < 0 or idx >= len(session_names):
+        if idx < 0 or idx >= len(rows):
             console.print("Неверный номер", style="red")
             return None
-        name = session_names[idx]
-        data = sessions[name]
-        server = next((s for s in servers if s["id"] == data["server_id"]), None)
+        server = db.server(rows[idx]["server_id"])
         if not server:
             console.print("Сервер для сессии не найден", style="red")
             return None
-        server["session_cwd"] = data["cwd"]
+        server["session_cwd"] = rows[idx]["cwd"]
         return server
     except Exception as e:
         console.print(f"Ошибка выбора сессии: {e}", style="red")
         return None
 
+# выбор серверов: all, имена или маски через запятую, tag:<тег>, group:<группа>
+def select_servers(servers, spec):
+    chosen = []
+    for part in (p.strip() for p in spec.split(",")):
+        if not part: continue
+        if part == "all": matched = servers
+        elif part.startswith("tag:"): matched = [s for s in servers if part[4:] in s.get("tags", [])]
+        elif part.startswith("group:"): matched = [s for s in servers if s.get("group") == part[6:]]
+        else: matched = [s for s in servers if fnmatch.fnmatch(s["name"], part)]
+        chosen += [s for s in matched if s not in chosen]
+    return chosen
+
+# команда на одном сервере с ограничением времени; stdout и stderr читаются одновременно
+def run_on_host(server, cmd, timeout=FANOUT_TIMEOUT):
+    started = time.time()
+    result = {"server": server, "rc": None, "out": "", "err": "", "error": None}
+    deadline = started + timeout
+    try:
+        # подключение тоже укладывается в таймаут хоста: недоступный сервер или долгая авторизация
+        # не задерживают общий результат; опоздавший канал закрывается, соединение остаётся в пуле
+        connecting = in_background(pool.channel, server)
+        if not wait([connecting], timeout=timeout)[0]:
+            connecting.add_done_callback(lambda f: f.exception() is None and f.result().close())
+            result["error"] = "таймаут подключения"
+            result["time"] = time.time() - started
+            return result
+        chan = connecting.result()
+        chan.exec_command(cmd)
+        out, err = b"", b""
+        while not chan.exit_status_ready() or chan.recv_ready() or chan.recv_stderr_ready():
+            if time.time() > deadline:
+                chan.close()
+                result["error"] = "таймаут"
+                break
+            if chan.recv_ready(): out = (out + chan.recv(65536))[:FANOUT_OUTPUT_LIMIT]
+            elif chan.recv_stderr_ready(): err = (err + chan.recv_stderr(65536))[:FANOUT_OUTPUT_LIMIT]
+            else: select.select([chan], [], [], 0.2)
+        else: result["rc"] = chan.recv_exit_status()
+        result["out"] = out.decode(errors="replace").rstrip()
+        result["err"] = err.decode(errors="replace").rstrip()
+    except Exception as e: result["error"] = str(e) or type(e).__name__
+    result["time"] = time.time() - started
+    return result
+
+# параллельный запуск с ограничением числа одновременных серверов
+def fanout(servers, cmd, workers=FANOUT_WORKERS, timeout=FANOUT_TIMEOUT):
+    if any(s.get("secret") for s in servers): vault.unlock()
+    results = []
+    with Progress(TextColumn("{task.description}"), BarColumn(), TextColumn("{task.completed}/{task.total}"), console=console, transient=True) as progress:
+        task = progress.add_task(f"⚡ {cmd}", total=len(servers))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            for result in ex.map(lambda s: run_on_host(s, cmd, timeout), servers):
+                results.append(result)
+                progress.advance(task)
+    return results
+
+# таблица результатов: серверы с одинаковым выводом и кодом схлопываются в одну строку
+def show_fanout(results):
+    groups = {}
+    for r in results: groups.setdefault((r["rc"], r["error"], r["out"], r["err"]), []).append(r)
+    t = Table(title=f"⚡ Результаты ({len(results)} серверов, {len(groups)} вариантов вывода)", box=box.ROUNDED, show_lines=True)
+    t.add_column("Серверы", style="cyan")
+    t.add_column("Код", justify="right")
+    t.add_column("Время", justify="right")
+    t.add_column("Вывод")
+    for (rc, error, out, err), rows in sorted(groups.items(), key=lambda g: -len(g[1])):
+        names = ", ".join(r["server"]["name"] for r in rows)
+        if len(rows) > 1: names += f" ({len(rows)})"
+        times = [r["time"] for r in rows]
+        duration = f"{min(times):.2f} с" if len(rows) == 1 else f"{min(times):.2f}–{max(times):.2f} с"
+        code = Text(error, style="red") if error else Text(str(rc), style="green" if rc == 0 else "red")
+        lines = (out + ("\n" if out and err else "")).splitlines() + [("\0" + line) for line in err.splitlines()]
+        output = Text()
+        for line in lines[:FANOUT_PREVIEW_LINES]:
+            if output: output.append("\n")
+            output.append(line[1:], style="red") if line.startswith("\0") else output.append(line)
+        if len(lines) > FANOUT_PREVIEW_LINES: output.append(f"\n… ещё {len(lines) - FANOUT_PREVIEW_LINES} строк", style="dim")
+        t.add_row(names, code, duration, output)
+    console.print(t)
+    ok = sum(1 for r in results if r["rc"] == 0)
+    console.print(f"✅ Успешно: {ok}  ❌ С ошибкой: {len(results) - ok}", style="bold")
+
+# выполнение команды на нескольких серверах
+def fanout_menu():
+    servers = db.inventory()[0]
+    if not servers:
+        console.print("Добавьте сервер", style="red")
+        return
+    show_labels()
+    chosen = [db.server(s["id"]) for s in select_servers(servers, Prompt.ask("Серверы (all, имена/маски через запятую, tag:тег, group:группа)", default="all"))]
+    if not chosen:
+        console.print("Нет подходящих серверов", style="yellow")
+        return
+    cmd = Prompt.ask(f"Команда для {len(chosen)} серверов").strip()
+    if not cmd: return
+    try:
+        workers = int(Prompt.ask("Одновременно серверов", default=str(FANOUT_WORKERS)))
+        timeout = float(Prompt.ask("Таймаут на сервер, с", default=str(FANOUT_TIMEOUT)))
+    except ValueError:
+        console.print("Введите число", style="red")
+        return
+    show_fanout(fanout(chosen, cmd, workers, timeout))
+
+# спарклайн последних значений; top — верх шкалы (по умолчанию максимум ряда)
+def sparkline(values, top=None):
+    values = list(values)
+    if not values: return ""
+    top = top or max(values) or 1
+    return "".join(SPARK_CHARS[min(len(SPARK_CHARS) - 1, int(v / top * (len(SPARK_CHARS) - 1) + 0.5))] for v in values)
+
+# один сервер на панели мониторинга: последние показатели и кольцевые буферы истории
+class HostSeries:
+    def __init__(self, server, history=DASH_HISTORY):
+        self.server = server
+        self.gauges = {}
+        self.cpu = deque(maxlen=history)
+        self.net = deque(maxlen=history)
+        self.rates = (0, 0)
+        self.chan = None
+        self.buffer = b""
+        self.error = None
+        self.seen = None
+
+    # байты из канала; строка длиннее DASH_LINE_LIMIT без перевода строки отбрасывается
+    def feed(self, data):
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        if len(self.buffer) > DASH_LINE_LIMIT: self.buffer = b""
+        for line in lines: self.apply(line.decode(errors="replace"))
+
+    # семпл: счётчики приходят приращениями, показатели — только изменившиеся
+    def apply(self, line):
+        fields = {}
+        for part in line.split():
+            key, _, value = part.partition("=")
+            try: fields[key] = float(value)
+            except ValueError: pass
+        now = time.time()
+        elapsed = now - self.seen if self.seen else None
+        self.seen = now
+        for key in ("M", "m", "l", "D", "d"):
+            if key in fields: self.gauges[key] = fields[key]
+        if fields.get("c"): self.cpu.append(100 * (1 - fields.get("i", 0) / fields["c"]))
+        if "r" in fields and elapsed:
+            self.rates = (fields["r"] / elapsed, fields.get("t", 0) / elapsed)
+            self.net.append(sum(self.rates))
+
+    def row(self):
+        name = self.server["name"]
+        if self.error: return [name, Text(self.error, style="red"), "", "", "", "", ""]
+        if self.seen is None: return [name, Text("подключение…", style="dim"), "", "", "", "", ""]
+        g = self.gauges
+        percent = lambda used, total: f"{used / total * 100:.0f}%" if total else "—"
+        cpu = f"{self.cpu[-1]:5.1f}%" if self.cpu else "—"
+        mem = f"{human_size(g.get('m', 0) * 1024)} / {human_size(g.get('M', 0) * 1024)} ({percent(g.get('m', 0), g.get('M', 0))})"
+        disk = f"{human_size(g.get('d', 0) * 1024)} / {human_size(g.get('D', 0) * 1024)} ({percent(g.get('d', 0), g.get('D', 0))})"
+        net = f"↓{human_size(self.rates[0])}/с ↑{human_size(self.rates[1])}/с"
+        return [name, Text(cpu + " ") + Text(sparkline(self.cpu, 100), style="green"), mem, f"{g.get('l', 0):.2f}", disk,
+                net, Text(sparkline(self.net), style="cyan")]
+
+# панель мониторинга: по каналу с семплером на сервер, все каналы читает один селектор
+# в потоке отрисовки; каналы открываются параллельно и подключаются к панели по мере готовности
+class Dashboard:
+    def __init__(self, servers, interval=DASH_INTERVAL, workers=FANOUT_WORKERS):
+        self.hosts = [HostSeries(s) for s in servers]
+        self.interval = interval
+        self.sel = selectors.DefaultSelector()
+        self.opener = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.pending = {self.opener.submit(self._open, host): host for host in self.hosts}
+
+    def _open(self, host):
+        chan = pool.channel(host.server)
+        chan.exec_command(f"awk -v interval={self.interval} -v every={DASH_DISK_EVERY} {shlex.quote(DASH_SAMPLER)} </dev/null")
+        return chan
+
+    def render(self):
+        t = Table(title=f"📊 Мониторинг: {len(self.hosts)} серверов, раз в {self.interval} с (Ctrl+C — выход)", box=box.SIMPLE)
+        for col in ["Сервер", "ЦПУ", "ОЗУ", "Load", "Диск /", "Сеть", "Сеть, история"]: t.add_column(col)
+        for host in self.hosts: t.add_row(*host.row())
+        return t
+
+    def _attach(self):
+        for future in [f for f in self.pending if f.done()]:
+            host = self.pending.pop(future)
+            try:
+                host.chan = future.result()
+                self.sel.register(host.chan, selectors.EVENT_READ, host)
+            except Exception as e: host.error = str(e) or type(e).__name__
+
+    def _read(self, host):
+        data = host.chan.recv(65536)
+        if data:
+            host.feed(data)
+            return
+        err = host.chan.recv_stderr(4096).decode(errors="replace").strip() if host.chan.recv_stderr_ready() else ""
+        host.error = err.splitlines()[0] if err else "семплер остановлен"
+        self.sel.unregister(host.chan)
+        host.chan.close()
+
+    def run(self):
+        with Live(self.render(), console=console, refresh_per_second=4) as live:
+            try:
+                while True:
+                    self._attach()
+                    if self.sel.get_map():
+                        for key, _ in self.sel.select(0.25): self._read(key.data)
+                    else: time.sleep(0.25)
+                    live.update(self.render())
+            except KeyboardInterrupt: pass
+            finally: self.close()
+
+    def close(self):
+        def discard(future):
+            if future.exception() is None: future.result().close()
+        for future in self.pending: future.add_done_callback(discard)
+        self.opener.shutdown(wait=False)
+        for host in self.hosts:
+            if host.chan: host.chan.close()
+        self.sel.close()
+
+# мониторинг нескольких серверов
+def dashboard_menu():
+    servers = db.inventory()[0]
+    if not servers:
+        console.print("Добавьте сервер", style="red")
+        return
+    show_labels()
+    chosen = [db.server(s["id"]) for s in select_servers(servers, Prompt.ask("Серверы (all, имена/маски через запятую, tag:тег, group:группа)", default="all"))]
+    if not chosen:
+        console.print("Нет подходящих серверов", style="yellow")
+        return
+    try:
+        interval = float(Prompt.ask("Интервал, с", default=str(DASH_INTERVAL)))
+        if interval <= 0: raise ValueError
+    except ValueError:
+        console.print("Введите число", style="red")
+        return
+    if any(s.get("secret") for s in chosen): vault.unlock()
+    Dashboard(chosen, interval).run()
+
+# шаги в порядке зависимостей; шаг идёт после всех, от которых зависит
+def provision_order(steps):
+    by_name = {step["name"]: step for step in steps}
+    order, seen = [], set()
+    def visit(step, path=()):
+        if step["name"] in seen: return
+        if step["name"] in path: raise ValueError(f"цикл в зависимостях: {step['name']}")
+        for need in step.get("needs", []): visit(by_name[need], path + (step["name"],))
+        seen.add(step["name"])
+        order.append(step)
+    for step in steps: visit(step)
+    return order
+
+# настройка одного сервера: каждый шаг ждёт код возврата, упавший шаг останавливает зависящие от него
+def provision_host(server, steps, progress=None, task=None):
+    sudo = "" if server["user"] == "root" else "sudo -n"
+    done = db.provisioned(server["id"]) if server.get("id") else set()
+    report = {"server": server, "ran": [], "skipped": [], "failed": [], "blocked": []}
+    ok = set()
+    for step in steps:
+        if progress: progress.update(task, description=f"{server['name']}: {step['title']}")
+        if any(need not in ok for need in step.get("needs", [])):
+            report["blocked"].append(step)
+        elif step["name"] in done:
+            report["skipped"].append(step)
+            ok.add(step["name"])
+        elif step.get("check") and run_on_host(server, step["check"].format(sudo=sudo), PROVISION_TIMEOUT)["rc"] == 0:
+            report["skipped"].append(step)
+            ok.add(step["name"])
+        else:
+            result = run_on_host(server, step["run"].format(sudo=sudo), PROVISION_TIMEOUT)
+            if result["rc"] == 0:
+                report["ran"].append(step)
+                ok.add(step["name"])
+            else:
+                lines = (result["err"] or result["out"]).strip().splitlines()
+                report["failed"].append((step, result["error"] or (lines[-1] if lines else f"код {result['rc']}")))
+        if step["name"] in ok and server.get("id") and step["name"] not in done: db.mark_provisioned(server["id"], step["name"])
+        if progress: progress.advance(task)
+    report["ok"] = all(step["name"] in ok for step in steps if not step.get("optional"))
+    if report["ok"] and server.get("id"): db.set_setup_done(server["id"])
+    server["setup_done"] = server.get("setup_done") or report["ok"]
+    if progress: progress.update(task, description=f"{server['name']}: {'✅ готово' if report['ok'] else '❌ ошибка'}")
+    return report
+
+# параллельная настройка серверов с прогрессом по каждому
+def provision(servers, steps=PROVISION_STEPS, workers=FANOUT_WORKERS, force=False):
+    steps = provision_order(steps)
+    if any(s.get("secret") for s in servers): vault.unlock()
+    if force:
+        for server in servers:
+            if server.get("id"): db.reset_provisioned(server["id"])
+    with Progress(TextColumn("{task.description}"), BarColumn(), TextColumn("{task.completed}/{task.total}"), console=console) as progress:
+        tasks = [progress.add_task(server["name"], total=len(steps)) for server in servers]
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            reports = list(ex.map(lambda a: provision_host(a[0], steps, progress, a[1]), zip(servers, tasks)))
+    t = Table(title="🔧 Настройка", box=box.ROUNDED, show_lines=True)
+    for col in ["Сервер", "Выполнено", "Уже было", "Ошибки"]: t.add_column(col)
+    for r in reports:
+        errors = Text()
+        for step, error in r["failed"]:
+            if errors: errors.append("\n")
+            errors.append(f"{step['title']}: ", style="bold")
+            errors.append(error, style="yellow" if step.get("optional") else "red")
+        if r["blocked"]:
+            if errors: errors.append("\n")
+            errors.append("Не запускались: " + ", ".join(step["title"] for step in r["blocked"]), style="dim")
+        name = Text(("✅ " if r["ok"] else "❌ ") + r["server"]["name"], style="green" if r["ok"] else "red")
+        t.add_row(name, str(len(r["ran"])), str(len(r["skipped"])), errors)
+    console.print(t)
+    return reports
+
+# настройка нескольких серверов из меню
+def provision_menu():
+    servers = db.inventory()[0]
+    if not servers:
+        console.print("Добавьте сервер", style="red")
+        return
+    show_labels()
+    chosen = [db.server(s["id"]) for s in select_servers(servers, Prompt.ask("Серверы (all, имена/маски через запятую, tag:тег, group:группа)", default="all"))]
+    if not chosen:
+        console.print("Нет подходящих серверов", style="yellow")
+        return
+    force = Confirm.ask("Повторить уже выполненные шаги?", default=False)
+    provision(chosen, force=force)
+
+# смена ключа шифрования и мастер-пароля
+def vault_menu():
+    console.print(f"🔐 Пароли защищены {'мастер-паролем' if vault.protected() else f'ключом из файла {vault.key_file}'}", style="cyan")
+    if not Confirm.ask("Сгенерировать новый ключ и перешифровать все пароли?", default=False): return
+    passphrase = Prompt.ask("Новый мастер-пароль (пусто — ключ в файле)", password=True, default="")
+    if passphrase and passphrase != Prompt.ask("Повторите мастер-пароль", password=True):
+        console.print("❌ Пароли не совпадают", style="red")
+        return
+    try: count = vault.rotate(passphrase or None)
+    except Exception as e:
+        console.print(f"❌ Ошибка смены ключа: {e}", style="red")
+        return
+    console.print(f"✅ Перешифровано паролей: {count}, старый ключ сохранён в {vault.key_file}.bak", style="green")
+
 # главное меню
 def main_menu():
     console.print(f"🚀 SSHSCRE {VERSION} — замена Termius (консоль)", style="red")
     console.print("→ Создатель: KilixKilik | GitHub: @KilixKilik", style="dim")
     
     while True:
-        console.print("\nМеню:\n1. Подключиться\n2. Восстановить сессию\n3. Добавить\n4. Список\n5. Выход", style="bold")
-        choice = Prompt.ask("→", choices=["1", "2", "3", "4", "5"])
+        console.print("\nМеню:\n1. Подключиться\n2. Восстановить сессию\n3. Добавить\n4. Список\n5. Выполнить на нескольких\n6. Настроить серверы\n7. Ключ шифрования\n8. Мониторинг\n9. Выход", style="bold")
+        choice = Prompt.ask("→", choices=["1", "2", "3", "4", "5", "6", "7", "8", "9"])
         if choice == "1":
-            servers = load_servers()
-            if not servers: 
-                console.print("Добавьте сервер", style="red")
-                continue
-            list_servers()
-            try:
-                idx = int(Prompt.ask("Номер")) - 1
-                if 0 <= idx < len(servers): connect_to_server(servers[idx])
-                else: console.print("Неверный номер", style="red")
-            except: console.print("Введите число", style="red")
+            server = browse_servers(pick=True)
+            if server: connect_to_server(server)
         elif choice == "2":
             server = restore_session()
             if server: connect_to_server(server)
         elif choice == "3": add_server()
         elif choice == "4": list_servers()
-        elif choice == "5": 
+        elif choice == "5": fanout_menu()
+        elif choice == "6": provision_menu()
+        elif choice == "7": vault_menu()
+        elif choice == "8": dashboard_menu()
+        elif choice == "9": 
+            pool.close_all()
             console.print("👋 Пока", style="red")
             break
 
+# создание или обновление структуры БД и прогрев соединений перед меню
+def start():
+    created = not os.path.exists(DB_FILE)
+    db.connect()
+    if created: console.print("✅ База данных создана", style="green")
+    elif db.migrated[0] < db.migrated[1]: console.print(f"✅ Структура базы данных обновлена до версии {db.migrated[1]}", style="green")
+    prewarm()
+
 if __name__ == "__main__":
-    # проверка структуры БД
-    if not os.path.exists(DB_FILE):
-        init_db()
-        console.print("✅ База данных создана", style="green")
-    else:
-        if not check_db_structure():
-            console.print("⚠️ Структура базы данных не соответствует требуемой. Запустите UpdateSQL.py для обновления.", style="yellow")
-            console.print("❌ Программа завершена", style="red")
-            exit(1)
-    
+    start()
     main_menu()
 
 # Github: @KilikKilix